@@ -1,7 +1,14 @@
 import ffmpeg
+import os
+import re
 import sqlite3
+import tarfile
 from pathlib import Path
 import logging
+from typing import Optional, Tuple
+from bat_acoustic_tools.db.migrate import require_current_schema
+from bat_acoustic_tools.db.utils import set_backup, set_record_path, split_path
+from bat_acoustic_tools.file_index import resolve_file
 from bat_acoustic_tools.utils import setup_logging
 
 """
@@ -10,11 +17,20 @@ This script:
 - Pulls out a list of file names from SQLite database
 - The list of files to extract can be customised using SQL query (-s/--sql flag) or use default values
 - The default query selects all files that haven't been backed up, aren't from CM and have a class_name of 'None'
-- The program iterates over list of file names and searches for each file in specified directory
+- The program iterates over list of file names and uses the stored record_path, or the file index
+  built by the `reindex` command when the file has moved. A file found through the index is only
+  used if its audio matches the record's content_hash, and the record_path is updated to it
 - When file is found, the file is converted to FLAC using ffmpeg and saved in specified directory
 - Original wav file is deleted at the end
+- With archive mode the FLAC files for each recording night are appended to a single uncompressed
+  tar file, and each file's byte offset and length within it are stored in the `records` table
+- An archive left unreadable by an interrupted backup is cut back to the last file committed to
+  the database, so the night can still be backed up
 """
 
+FILE_NAME_TIMESTAMP = re.compile(r"_(\d{8})_(\d{6})")
+
+
 
 def create_flac_path(wav_file: Path, flac_root: Path) -> Path:
     """
@@ -37,10 +53,170 @@ def create_flac_path(wav_file: Path, flac_root: Path) -> Path:
 
     return flac_dir / (wav_file.stem + ".flac")
 
-def main(wav_directory, flac_directory, db_path, sql_query):
+
+def create_archive_path(wav_file: Path, flac_root: Path, recording_night: str) -> Path:
+    """
+    Returns the path of the per-night archive a WAV file's FLAC backup is appended to, using the
+    same directory structure as `create_flac_path`.
+
+    Args:
+        wav_file (Path): Path to the source WAV file.
+        flac_root (Path): Root directory for the FLAC file structure.
+        recording_night (str): Recording night of the file, e.g. 2024-04-15.
+
+    Returns:
+        Path: Path to the tar archive for the night.
+    """
+    flac_dir = create_flac_path(wav_file, flac_root).parent
+
+    return flac_dir / (recording_night + ".tar")
+
+
+def get_recording_night(conn: sqlite3.Connection, record_id: int, file_name: str) -> str:
+    """
+    Returns the recording night stored for a record, falling back to the date in the file name.
+    Files recorded before midday belong to the previous night.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "select recording_night from record_data where id = ?",
+        (record_id,),
+    )
+    row = cur.fetchone()
+    if row is not None and row[0] is not None:
+        return str(row[0])
+
+    match = FILE_NAME_TIMESTAMP.search(file_name)
+    if match is None:
+        return "unknown"
+    record_date, record_time = match.groups()
+    cur.execute(
+        "select date(?, case when ? < '120000' then '-1 day' else '+0 days' end)",
+        (f"{record_date[:4]}-{record_date[4:6]}-{record_date[6:]}", record_time),
+    )
+    return cur.fetchone()[0]
+
+
+def _padded_size(size: int) -> int:
+    # tar stores each member's data padded to a whole block
+    blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+    return (blocks + (remainder > 0)) * tarfile.BLOCKSIZE
+
+
+def sync_file(path: Path) -> None:
+    """
+    Flushes a file written by another process, e.g. ffmpeg, from the OS cache to disk.
+    """
+    # opened for writing as Windows cannot fsync a read-only handle
+    with open(path, "r+b") as f:
+        os.fsync(f.fileno())
+
+
+def append_to_archive(archive: tarfile.TarFile, flac_file: Path) -> Tuple[int, int]:
+    """
+    Appends a FLAC file to an open tar archive and flushes it to disk.
+
+    Args:
+        archive (tarfile.TarFile): Archive opened in append mode.
+        flac_file (Path): FLAC file to add, stored under its file name.
+
+    Returns:
+        Tuple[int, int]: Byte offset and length of the file's data within the archive.
+    """
+    member = archive.gettarinfo(str(flac_file), arcname=flac_file.name)
+    with open(flac_file, "rb") as f:
+        archive.addfile(member, f)
+    archive.fileobj.flush()
+    os.fsync(archive.fileobj.fileno())
+
+    # addfile leaves archive.offset after the data and its padding to a whole block
+    return archive.offset - _padded_size(member.size), member.size
+
+
+def archived_end(conn: sqlite3.Connection, archive_path: Path) -> int:
+    """
+    Returns where the last member of an archive with a committed backup ends, including its
+    padding, or 0 if no record is backed up to the archive.
+    """
+    root_ref, stored_path = split_path(conn, str(archive_path))
+    end = conn.execute(
+        """
+        select max(archive_offset + archive_length) from record_data
+        where backup_root_ref is ? and backup_path = ? and archive_offset is not NULL
+        """,
+        (root_ref, stored_path),
+    ).fetchone()[0]
+    return _padded_size(end or 0)
+
+
+def open_archive(conn: sqlite3.Connection, archive_path: Path) -> Optional[tarfile.TarFile]:
+    """
+    Opens a per-night archive for appending, creating it if needed.
+
+    An archive that cannot be read, e.g. one truncated by an interrupted backup, is cut back to
+    the end of the last member recorded in the database. Nothing after that point was committed,
+    so the WAV files it came from still exist and are backed up again.
+
+    Returns:
+        Optional[tarfile.TarFile]: The open archive, or None if it is damaged before that point.
+    """
+    try:
+        return tarfile.open(archive_path, "a")
+    except tarfile.ReadError as e:
+        logging.warning(f"Unable to open {archive_path} for appending: {e}")
+
+    end = archived_end(conn, archive_path)
+    logging.warning(f"Truncating {archive_path} to {end} bytes, the end of its last backed up file")
+    with open(archive_path, "r+b") as f:
+        f.truncate(end)
+        f.seek(end)
+        # tarfile only appends to an archive that ends with an end of archive marker
+        f.write(bytes(2 * tarfile.BLOCKSIZE))
+        f.flush()
+        os.fsync(f.fileno())
+
+    try:
+        return tarfile.open(archive_path, "a")
+    except tarfile.ReadError as e:
+        logging.error(f"Unable to open {archive_path} for appending: {e}")
+        return None
+
+
+def read_archived_file(archive_path: Path, offset: int, length: int) -> bytes:
+    """
+    Reads a single backed up file from a per-night archive without scanning the archive.
+
+    Args:
+        archive_path (Path): Path to the tar archive, the `backup_path` of the record.
+        offset (int): `archive_offset` of the record.
+        length (int): `archive_length` of the record.
+
+    Returns:
+        bytes: Contents of the FLAC file.
+    """
+    with open(archive_path, "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def convert_to_flac(wav_file_path: Path, backup_path: Path) -> None:
+    ffmpeg.input(str(wav_file_path)).output(
+        str(backup_path),
+        format="flac",
+        audio_bitrate="6144k",
+        acodec="flac",
+        ar=384000,
+        map_metadata=0,
+        loglevel="quiet",
+    ).run(overwrite_output=True)
+
+
+def main(wav_directory, flac_directory, db_path, sql_query, archive: bool = False):
     setup_logging()
 
     with sqlite3.connect(db_path) as conn:
+        require_current_schema(conn)
+
         # create cursor and execute query to return names of files to be converted
         cur = conn.cursor()
         cur.execute(sql_query)
@@ -49,6 +225,9 @@ def main(wav_directory, flac_directory, db_path, sql_query):
 
         logging.info(f"{result_count} files to be backed up")
 
+        current_archive: Optional[tarfile.TarFile] = None
+        current_archive_path = None
+
         # start loop over file list
         for count, result in enumerate(results, 1):
             file_name, file_path = result
@@ -57,36 +236,58 @@ def main(wav_directory, flac_directory, db_path, sql_query):
                 f"Backing up file {count} of {result_count} ({round((count/result_count) * 100, 1)}%) - File name: {file_name}"
             )
 
-            # use find file to identify wav path
-            # TODO this is inefficient and would be better if the relative path was stored in DB to remove need to search
-            # therefore in future add wav path field to sqlite db
-            # wav_file_path = find_file(file_name, wav_directory)
-            wav_file_path = Path(file_path)
+            record = conn.execute(
+                "select id, content_hash from records where file_name = ? and record_path is ?",
+                (file_name, file_path),
+            ).fetchone()
+            if record is None:
+                logging.error(f"{file_name} at {file_path} is not a record in the database, skipping")
+                continue
+            record_id, content_hash = record
+
+            # use stored path, falling back to the file index (see `reindex`) if the file has moved
+            wav_file_path = Path(file_path) if file_path else None
+            if wav_file_path is None or not wav_file_path.exists():
+                wav_file_path = resolve_file(conn, file_name, content_hash)
+                if wav_file_path is not None:
+                    logging.info(f"{file_name} found at {wav_file_path}")
+                    set_record_path(conn, record_id, wav_file_path)
             # if wav is found then start backup process
             if wav_file_path is not None:
-                # return backup path for file
-                backup_path = create_flac_path(wav_file_path, flac_directory)
+                flac_path = None
                 try:
-                    # execute backup using ffmpeg
-                    ffmpeg.input(str(wav_file_path)).output(
-                        str(backup_path),
-                        audio_bitrate="6144k",
-                        acodec="flac",
-                        ar=384000,
-                        map_metadata=0,
-                        loglevel="quiet",
-                    ).run()
-
-                    cur2 = conn.cursor()
-                    cur2.execute(
-                        "update records set backup = 'yes', backup_path = ? where file_name = ?",
-                        (str(backup_path), file_name),
-                    )
-                    logging.info(f"Backup of {file_name} complete - deleting WAV file")
+                    if archive:
+                        night = get_recording_night(conn, record_id, file_name)
+                        archive_path = create_archive_path(wav_file_path, flac_directory, night)
+                        if archive_path != current_archive_path:
+                            if current_archive is not None:
+                                current_archive.close()
+                            current_archive = open_archive(conn, archive_path)
+                            current_archive_path = archive_path
+                        if current_archive is None:
+                            logging.error(
+                                f"{archive_path} is damaged, {file_name} not backed up"
+                            )
+                            continue
+
+                        # encode next to the archive, then append and remove the single file
+                        flac_path = archive_path.with_name(wav_file_path.stem + ".flac")
+                        convert_to_flac(wav_file_path, flac_path)
+                        offset, length = append_to_archive(current_archive, flac_path)
+                        flac_path.unlink()
+                        backup_path = archive_path
+                    else:
+                        # return backup path for file
+                        backup_path = create_flac_path(wav_file_path, flac_directory)
+                        # execute backup using ffmpeg
+                        convert_to_flac(wav_file_path, backup_path)
+                        sync_file(backup_path)
+                        offset, length = None, None
 
-                    # commit every 10th iteration
-                    if count % 10 == 0:
-                        conn.commit()
+                    # the backup must be on disk and its location committed before the only other
+                    # copy is deleted
+                    set_backup(conn, record_id, backup_path, offset, length)
+                    logging.info(f"Backup of {file_name} complete - deleting WAV file")
 
                     # delete wav file after converson
                     wav_file_path.unlink()
@@ -95,8 +296,14 @@ def main(wav_directory, flac_directory, db_path, sql_query):
                     logging.error(
                         f"Error converting {file_name} to FLAC, continuing to next file"
                     )
+                    if flac_path is not None:
+                        # partly written file next to the archive
+                        flac_path.unlink(missing_ok=True)
             else:
-                logging.info(f"{file_name} not found in {str(wav_directory)}")
+                logging.info(f"{file_name} not found in {str(wav_directory)} or the file index")
+
+        if current_archive is not None:
+            current_archive.close()
 
 if __name__ == "__main__":
     main()
@@ -2,7 +2,20 @@
 import typer
 from pathlib import Path
 from typing_extensions import Annotated, Optional
-from bat_acoustic_tools import process_wavs, backup_wavs
+import logging
+import sqlite3
+from typing import List
+from bat_acoustic_tools import (
+    process_wavs,
+    backup_wavs,
+    inference,
+    file_index,
+    extract,
+    reanalyse,
+)
+from bat_acoustic_tools.inference import Backend
+from bat_acoustic_tools.db import migrate
+from bat_acoustic_tools.utils import setup_logging
 
 app = typer.Typer(help="Manage bat bioacoustic wav files")
 
@@ -12,11 +25,11 @@ def process_wav_cli(
     directory: Annotated[
         Optional[Path],
         typer.Argument(
-            help="Path to directory containing WAV files",
+            help="Path to directory containing WAV files, not needed with --backups",
             exists=True,
             resolve_path=True,
         ),
-    ],
+    ] = None,
     db_path: Annotated[
         Optional[Path],
         typer.Option(
@@ -37,8 +50,144 @@ def process_wav_cli(
             help="BatDetect2 Detection threshold, a value from 0 to 1, defaults to 0.5",
         ),
     ] = 0.5,
+    watch: Annotated[
+        bool,
+        typer.Option(
+            "--watch",
+            "-w",
+            help="Watch the directory and analyse new WAV files as they are copied in",
+        ),
+    ] = False,
+    settle: Annotated[
+        float,
+        typer.Option(
+            "--settle",
+            min=0,
+            help="Watch mode: seconds a file must be unchanged before it is analysed, defaults to 10",
+        ),
+    ] = 10.0,
+    idle_timeout: Annotated[
+        Optional[float],
+        typer.Option(
+            "--idle-timeout",
+            min=0,
+            help="Watch mode: stop after this many seconds without a new file, defaults to watching until interrupted",
+        ),
+    ] = None,
+    backend: Annotated[
+        Backend,
+        typer.Option(
+            "--backend",
+            "-b",
+            help="Inference backend, torchscript and onnx run an exported copy of the BatDetect2 model on CPU",
+        ),
+    ] = Backend.pytorch,
+    quantize: Annotated[
+        bool,
+        typer.Option(
+            "--quantize",
+            help="Use int8 quantised weights (onnx backend only)",
+        ),
+    ] = False,
+    backups: Annotated[
+        bool,
+        typer.Option(
+            "--backups",
+            help="Re-analyse records already in the database, reading FLAC backups when the WAV file has been deleted",
+        ),
+    ] = False,
+    sql: Annotated[
+        str,
+        typer.Option(
+            "--sql",
+            "-s",
+            help="Backups mode: SQL query selecting the record ids to re-analyse, must return a single id field",
+        ),
+    ] = "select id from records where backup = 'yes'",
+    workers: Annotated[
+        Optional[int],
+        typer.Option(
+            "--workers",
+            min=1,
+            help="Backups mode: number of recordings analysed in parallel, defaults to the number of CPUs",
+        ),
+    ] = None,
+):
+    if backups and watch:
+        raise typer.BadParameter("--watch cannot be used with --backups")
+    try:
+        inference.check_backend(backend, quantize)
+    except ValueError as e:
+        raise typer.BadParameter(str(e))
+    if backups:
+        reanalyse.main(
+            db_path=db_path,
+            sql_query=sql,
+            threshold=threshold,
+            backend=backend,
+            quantize=quantize,
+            workers=workers,
+        )
+    elif directory is None:
+        raise typer.BadParameter("A WAV directory is required unless --backups is used")
+    elif watch:
+        process_wavs.watch(
+            wav_directory=directory,
+            db_path=db_path,
+            threshold=threshold,
+            settle_time=settle,
+            idle_timeout=idle_timeout,
+            backend=backend,
+            quantize=quantize,
+        )
+    else:
+        process_wavs.main(
+            wav_directory=directory,
+            db_path=db_path,
+            threshold=threshold,
+            backend=backend,
+            quantize=quantize,
+        )
+
+
+@app.command("benchmark")
+def benchmark_cli(
+    directory: Annotated[
+        Optional[Path],
+        typer.Argument(
+            help="Path to directory containing WAV files to time",
+            exists=True,
+            resolve_path=True,
+        ),
+    ],
+    threshold: Annotated[
+        float,
+        typer.Option(
+            "--threshold",
+            "-t",
+            min=0,
+            max=1,
+            help="BatDetect2 Detection threshold, a value from 0 to 1, defaults to 0.5",
+        ),
+    ] = 0.5,
 ):
-    process_wavs.main(wav_directory=directory, db_path=db_path, threshold=threshold)
+    """Report files/sec for each inference backend on the same WAV files"""
+    setup_logging()
+    from batdetect2 import api
+
+    audio_files = api.list_audio_files(directory)
+    if not audio_files:
+        logging.error("WAV directory is empty, exiting script")
+        raise typer.Exit(code=1)
+
+    conf = process_wavs.get_config(threshold)
+    backends = []
+    for backend, quantize in inference.BENCHMARK_BACKENDS:
+        if not inference.backend_available(backend):
+            logging.info(f"Skipping {backend.value} backend, install the {backend.value} extra to include it")
+            continue
+        backends.append(inference.load_backend(backend, quantize=quantize))
+    inference.benchmark(backends, audio_files, conf)
 
 
 @app.command('backup')
@@ -74,12 +223,190 @@ def backup_wavs_cli(
         typer.Option(
             "--sql",
             "-s",
-            help="SQL query used to create list of file names, must return file_name and record_path fields", 
+            help="SQL query used to create list of file names, must return file_name and record_path fields, ordering by record_path lets archive mode open each night's archive once", 
         )
-    ] = "select file_name, record_path from records where class_name = 'None' and backup = 'no' and record_path not NULL"
+    ] = "select r.file_name, coalesce(s.path || '/' || r.record_path, r.record_path) from record_data r left join storage_roots s on s.id = r.record_root_ref where r.class_ref = (select id from species where name = 'None') and r.backup = 'no' and r.record_path not NULL order by s.path, r.record_path",
+    archive: Annotated[
+        bool,
+        typer.Option(
+            "--archive",
+            "-a",
+            help="Append FLAC files to one uncompressed tar archive per recording night instead of writing individual files",
+        )
+    ] = False,
 ): 
-    backup_wavs.main(wav_directory=wav_directory, flac_directory=backup_directory, db_path=db_path, sql_query=sql)
+    backup_wavs.main(wav_directory=wav_directory, flac_directory=backup_directory, db_path=db_path, sql_query=sql, archive=archive)
     
 
+@app.command("migrate")
+def migrate_cli(
+    db_path: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--db-path",
+            "-d",
+            help="Path to sqlite3 database to migrate, defaults to sqlite3.db",
+            exists=True,
+            resolve_path=True,
+        ),
+    ] = Path.cwd() / "sqlite3.db",
+    batch_size: Annotated[
+        int,
+        typer.Option(
+            "--batch-size",
+            min=1,
+            help="Number of rows copied per transaction, defaults to 50000",
+        ),
+    ] = 50000,
+    vacuum: Annotated[
+        bool,
+        typer.Option(
+            "--vacuum/--no-vacuum",
+            help="Rebuild the database file after migrating to reclaim space, needs free disk space roughly the size of the database",
+        ),
+    ] = True,
+):
+    """Migrate a database from flat records/annotations tables to the normalised schema"""
+    setup_logging()
+    migrate.migrate(db_path=db_path, batch_size=batch_size, vacuum=vacuum)
+
+
+@app.command("reindex")
+def reindex_cli(
+    roots: Annotated[
+        List[Path],
+        typer.Argument(
+            help=r"Storage root directories to index, e.g. 'D:\Goblin Combe - Bat Data\2024\Deployments'",
+            exists=True,
+            resolve_path=True,
+        ),
+    ],
+    db_path: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--db-path",
+            "-d",
+            help="Path to sqlite3 database, defaults to sqlite3.db",
+            exists=True,
+            resolve_path=True,
+        ),
+    ] = Path.cwd() / "sqlite3.db",
+    workers: Annotated[
+        int,
+        typer.Option(
+            "--workers",
+            "-w",
+            min=1,
+            help="Number of directories scanned in parallel, defaults to 8",
+        ),
+    ] = 8,
+):
+    """Index WAV, FLAC and archive files under storage roots so moved files can be found"""
+    setup_logging()
+    file_index.reindex(db_path=db_path, roots=roots, workers=workers)
+
+
+@app.command("remap-root")
+def remap_root_cli(
+    old_root: Annotated[
+        Path,
+        typer.Argument(help=r"Indexed storage root as it was indexed, e.g. 'D:\Goblin Combe - Bat Data\2024'"),
+    ],
+    new_root: Annotated[
+        Path,
+        typer.Argument(
+            help=r"Where the storage root is now mounted, e.g. 'E:\Goblin Combe - Bat Data\2024'",
+            exists=True,
+            resolve_path=True,
+        ),
+    ],
+    db_path: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--db-path",
+            "-d",
+            help="Path to sqlite3 database, defaults to sqlite3.db",
+            exists=True,
+            resolve_path=True,
+        ),
+    ] = Path.cwd() / "sqlite3.db",
+):
+    """Point an indexed storage root, and record paths under it, at a new location without reindexing"""
+    setup_logging()
+    with sqlite3.connect(db_path) as conn:
+        migrate.require_current_schema(conn)
+        updated = file_index.remap_root(conn, old_root, new_root)
+    if updated:
+        logging.info(f"{old_root} remapped to {new_root}")
+    else:
+        logging.error(f"{old_root} is not an indexed storage root")
+
+
+@app.command("extract")
+def extract_cli(
+    output_directory: Annotated[
+        Path,
+        typer.Argument(
+            help="Directory to write call clips and spectrograms to, created if it does not exist",
+            resolve_path=True,
+        ),
+    ],
+    db_path: Annotated[
+        Optional[Path],
+        typer.Option(
+            "--db-path",
+            "-d",
+            help="Path to sqlite3 database, defaults to sqlite3.db",
+            exists=True,
+            resolve_path=True,
+        ),
+    ] = Path.cwd() / "sqlite3.db",
+    sql: Annotated[
+        str,
+        typer.Option(
+            "--sql",
+            "-s",
+            help="SQL query selecting the annotation ids to extract, must return a single id field",
+        ),
+    ] = "select a.id from annotations a join records r on r.id = a.record_id where r.validated = 'no'",
+    padding: Annotated[
+        float,
+        typer.Option(
+            "--padding",
+            "-p",
+            min=0,
+            help="Seconds of audio to include either side of each call, defaults to 0.02",
+        ),
+    ] = 0.02,
+    clips: Annotated[
+        bool,
+        typer.Option("--clips/--no-clips", help="Write a WAV clip of each call"),
+    ] = True,
+    spectrograms: Annotated[
+        bool,
+        typer.Option("--spectrograms/--no-spectrograms", help="Write a spectrogram PNG of each call"),
+    ] = True,
+    workers: Annotated[
+        Optional[int],
+        typer.Option(
+            "--workers",
+            "-w",
+            min=1,
+            help="Number of recordings processed in parallel, defaults to the number of CPUs",
+        ),
+    ] = None,
+):
+    """Write short clips and spectrograms of individual calls for validation"""
+    extract.main(
+        db_path=db_path,
+        output_dir=output_directory,
+        sql_query=sql,
+        padding=padding,
+        clips=clips,
+        spectrograms=spectrograms,
+        workers=workers,
+    )
+
+
 if __name__ == "__main__":
     app()
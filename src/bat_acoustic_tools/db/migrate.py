@@ -0,0 +1,318 @@
+import logging
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from bat_acoustic_tools.db.utils import (
+    FILE_INDEX,
+    SCHEMA,
+    SCHEMA_VERSION,
+    STORAGE_ROOTS,
+    relativise_paths,
+)
+
+"""
+Migrates databases created with the original flat `records` / `annotations` tables to
+the normalised schema, where species, locations, detectors and call events are stored
+once in lookup tables and referenced by integer ids.
+
+Rows are copied in batches ordered by id and committed as they go, so memory use is
+constant and an interrupted migration can be resumed by running it again.
+
+Normalised databases carry their schema version in `PRAGMA user_version` and are brought
+up to date by the functions in `UPGRADES`.
+"""
+
+# Representative scans used to report query time before and after migration
+FLAT_BENCHMARK_QUERIES = [
+    "SELECT spp_class, count(*) FROM annotations GROUP BY spp_class",
+    "SELECT location_id, class_name, count(*) FROM records WHERE class_name <> 'None' GROUP BY location_id, class_name",
+]
+
+# The same scans against the base tables, grouping on ids and joining names onto the result
+BENCHMARK_QUERIES = [
+    """
+    SELECT s.name, a.n FROM (
+        SELECT species_ref, count(*) AS n FROM annotation_data GROUP BY species_ref
+    ) a
+    LEFT JOIN species s ON s.id = a.species_ref
+    """,
+    """
+    SELECT l.name, s.name, r.n FROM (
+        SELECT location_ref, class_ref, count(*) AS n FROM record_data
+        WHERE class_ref <> (SELECT id FROM species WHERE name = 'None')
+        GROUP BY location_ref, class_ref
+    ) r
+    LEFT JOIN locations l ON l.id = r.location_ref
+    LEFT JOIN species s ON s.id = r.class_ref
+    """,
+]
+
+COPY_RECORDS = """
+INSERT INTO record_data(id, file_name, location_ref, detector_ref, record_time, duration, class_ref, recording_night, validated, id_correct, comments, backup, backup_path, record_path)
+SELECT r.id, r.file_name, l.id, d.id, r.record_time, r.duration, s.id, r.recording_night, r.validated, r.id_correct, r.comments, r.backup, r.backup_path, r.record_path
+FROM legacy_records r
+LEFT JOIN locations l ON l.name = r.location_id
+LEFT JOIN detectors d ON d.name = r.serial
+LEFT JOIN species s ON s.name = r.class_name
+WHERE r.id > ?
+ORDER BY r.id
+LIMIT ?
+"""
+
+COPY_ANNOTATIONS = """
+INSERT INTO annotation_data(id, record_id, start_time, end_time, low_freq, high_freq, species_ref, class_prob, det_prob, individual, event_ref)
+SELECT a.id, a.record_id, a.start_time, a.end_time, a.low_freq, a.high_freq, s.id, a.class_prob, a.det_prob, a.individual, e.id
+FROM legacy_annotations a
+LEFT JOIN species s ON s.name = a.spp_class
+LEFT JOIN events e ON e.name = a.event
+WHERE a.id > ?
+ORDER BY a.id
+LIMIT ?
+"""
+
+FILL_LOOKUPS = [
+    "INSERT OR IGNORE INTO locations(name) SELECT DISTINCT location_id FROM legacy_records WHERE location_id IS NOT NULL",
+    "INSERT OR IGNORE INTO detectors(name) SELECT DISTINCT serial FROM legacy_records WHERE serial IS NOT NULL",
+    "INSERT OR IGNORE INTO species(name) SELECT DISTINCT class_name FROM legacy_records WHERE class_name IS NOT NULL",
+    "INSERT OR IGNORE INTO species(name) SELECT DISTINCT spp_class FROM legacy_annotations WHERE spp_class IS NOT NULL",
+    "INSERT OR IGNORE INTO events(name) SELECT DISTINCT event FROM legacy_annotations WHERE event IS NOT NULL",
+]
+
+
+def _object_type(conn: sqlite3.Connection, name: str) -> str | None:
+    cur = conn.cursor()
+    cur.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _is_flat(conn: sqlite3.Connection) -> bool:
+    return (
+        _object_type(conn, "records") == "table"
+        or _object_type(conn, "legacy_records") == "table"
+    )
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def needs_migration(conn: sqlite3.Connection) -> bool:
+    """
+    Returns True if the database uses the flat schema, a previous migration was interrupted
+    or the normalised schema is older than `SCHEMA_VERSION`.
+    """
+    return _is_flat(conn) or (
+        _object_type(conn, "records") == "view"
+        and schema_version(conn) < SCHEMA_VERSION
+    )
+
+
+def require_current_schema(conn: sqlite3.Connection) -> None:
+    """
+    Exits with an error if the database has to be migrated before it can be used.
+    """
+    if needs_migration(conn):
+        logging.error(
+            "Database uses an older schema, run the `migrate` command first"
+        )
+        sys.exit()
+
+
+def _drop_views(conn: sqlite3.Connection) -> None:
+    # triggers on the views are dropped with them
+    conn.execute("DROP VIEW IF EXISTS records")
+    conn.execute("DROP VIEW IF EXISTS annotations")
+
+
+def _add_content_hash(conn: sqlite3.Connection) -> None:
+    """
+    Version 2: adds `record_data.content_hash` and drops the UNIQUE constraint on
+    `file_name` so recordings from different detectors may share a name.
+    """
+    _drop_views(conn)
+    conn.execute(
+        """
+        CREATE TABLE record_data_new (
+            id INTEGER PRIMARY KEY,
+            file_name TEXT,
+            location_ref INTEGER REFERENCES locations(id),
+            detector_ref INTEGER REFERENCES detectors(id),
+            record_time TIMESTAMP,
+            duration FLOAT,
+            class_ref INTEGER REFERENCES species(id),
+            recording_night DATE,
+            validated TEXT DEFAULT 'no',
+            id_correct TEXT,
+            comments TEXT,
+            backup TEXT,
+            backup_path TEXT,
+            record_path TEXT,
+            content_hash TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        INSERT INTO record_data_new(id, file_name, location_ref, detector_ref, record_time, duration, class_ref, recording_night, validated, id_correct, comments, backup, backup_path, record_path)
+        SELECT id, file_name, location_ref, detector_ref, record_time, duration, class_ref, recording_night, validated, id_correct, comments, backup, backup_path, record_path
+        FROM record_data
+        """
+    )
+    conn.execute("DROP TABLE record_data")
+    conn.execute("ALTER TABLE record_data_new RENAME TO record_data")
+
+
+def _add_archive_columns(conn: sqlite3.Connection) -> None:
+    """
+    Version 3: adds the byte offset and length of backups packed into per-night archives.
+    """
+    _drop_views(conn)
+    conn.execute("ALTER TABLE record_data ADD COLUMN archive_offset INTEGER")
+    conn.execute("ALTER TABLE record_data ADD COLUMN archive_length INTEGER")
+
+
+def _add_file_index(conn: sqlite3.Connection) -> None:
+    """
+    Version 4: adds the `storage_roots` and `file_index` tables used by `reindex`.
+    """
+    conn.execute(STORAGE_ROOTS)
+    conn.execute(FILE_INDEX)
+
+
+def _add_path_roots(conn: sqlite3.Connection) -> None:
+    """
+    Version 5: stores `record_path` and `backup_path` relative to a storage root where possible,
+    so `remap-root` also moves the paths of records.
+    """
+    _drop_views(conn)
+    conn.execute(
+        "ALTER TABLE record_data ADD COLUMN record_root_ref INTEGER REFERENCES storage_roots(id)"
+    )
+    conn.execute(
+        "ALTER TABLE record_data ADD COLUMN backup_root_ref INTEGER REFERENCES storage_roots(id)"
+    )
+    # deepest roots first so each path is relative to the innermost root containing it
+    roots = conn.execute("SELECT id, path FROM storage_roots ORDER BY length(path) DESC")
+    for root_id, root in roots.fetchall():
+        relativise_paths(conn, root_id, Path(root))
+
+
+# schema version -> function upgrading a database from that version to the next
+UPGRADES = {
+    1: _add_content_hash,
+    2: _add_archive_columns,
+    3: _add_file_index,
+    4: _add_path_roots,
+}
+
+
+def time_queries(conn: sqlite3.Connection, queries: list[str]) -> float:
+    """
+    Runs each query and returns the total time taken in seconds.
+    """
+    start = time.perf_counter()
+    for query in queries:
+        conn.execute(query).fetchall()
+    return time.perf_counter() - start
+
+
+def _copy_in_batches(
+    conn: sqlite3.Connection, query: str, table: str, batch_size: int
+) -> None:
+    last_id = conn.execute(f"SELECT coalesce(max(id), 0) FROM {table}").fetchone()[0]
+    total = 0
+    while True:
+        cur = conn.execute(query, (last_id, batch_size))
+        copied = cur.rowcount
+        conn.commit()
+        if copied <= 0:
+            break
+        total += copied
+        last_id = conn.execute(f"SELECT max(id) FROM {table}").fetchone()[0]
+        logging.info(f"{total} rows copied to {table}")
+
+
+def _convert_flat(conn: sqlite3.Connection, batch_size: int) -> None:
+    if _object_type(conn, "records") == "table":
+        logging.info("Renaming flat tables")
+        conn.execute("ALTER TABLE records RENAME TO legacy_records")
+        conn.execute("ALTER TABLE annotations RENAME TO legacy_annotations")
+    else:
+        logging.info("Resuming interrupted migration")
+
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+    logging.info("Populating lookup tables")
+    for statement in FILL_LOOKUPS:
+        conn.execute(statement)
+    conn.commit()
+
+    logging.info("Copying records")
+    _copy_in_batches(conn, COPY_RECORDS, "record_data", batch_size)
+    logging.info("Copying annotations")
+    _copy_in_batches(conn, COPY_ANNOTATIONS, "annotation_data", batch_size)
+
+    conn.execute("DROP TABLE legacy_annotations")
+    conn.execute("DROP TABLE legacy_records")
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    conn.commit()
+
+
+def _upgrade(conn: sqlite3.Connection) -> None:
+    version = schema_version(conn)
+    while version < SCHEMA_VERSION:
+        logging.info(f"Upgrading schema from version {version} to {version + 1}")
+        # run each upgrade in a single transaction, DDL included
+        conn.execute("BEGIN")
+        UPGRADES[version](conn)
+        version += 1
+        conn.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def migrate(db_path: Path, batch_size: int = 50000, vacuum: bool = True) -> None:
+    """
+    Migrates a database to the current normalised schema in place.
+
+    Args:
+        db_path (Path): Path to the sqlite3 database.
+        batch_size (int): Number of rows copied per transaction.
+        vacuum (bool): Rebuild the database file afterwards to return freed pages to disk,
+                       this needs free space roughly equal to the migrated database size.
+    """
+    with sqlite3.connect(db_path) as conn:
+        if not needs_migration(conn):
+            logging.info("Database already uses the current schema")
+            return
+
+        size_before = db_path.stat().st_size
+        query_time_before = None
+
+        if _is_flat(conn):
+            if _object_type(conn, "records") == "table":
+                query_time_before = time_queries(conn, FLAT_BENCHMARK_QUERIES)
+            _convert_flat(conn, batch_size)
+        else:
+            _upgrade(conn)
+
+        if vacuum:
+            logging.info("Vacuuming database")
+            conn.execute("VACUUM")
+
+        query_time_after = time_queries(conn, BENCHMARK_QUERIES)
+
+    size_after = db_path.stat().st_size
+    logging.info(
+        f"Database size {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB"
+    )
+    if query_time_before is not None:
+        logging.info(
+            f"Benchmark query time {query_time_before:.2f}s -> {query_time_after:.2f}s"
+        )
@@ -2,47 +2,217 @@ import logging
 import time
 import sqlite3
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
+
+
+SCHEMA_VERSION = 5
+
+# Repeated strings are stored once in lookup tables and referenced by integer id
+LOOKUP_TABLES = ("species", "locations", "detectors", "events")
+
+LOOKUPS = [
+    f"""
+CREATE TABLE IF NOT EXISTS {table} (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+"""
+    for table in LOOKUP_TABLES
+]
 
 
 RECORDS = """
-CREATE TABLE IF NOT EXISTS records (
+CREATE TABLE IF NOT EXISTS record_data (
     id INTEGER PRIMARY KEY,
-    file_name TEXT UNIQUE,
-    location_id TEXT,
-    serial TEXT,
+    file_name TEXT,
+    location_ref INTEGER REFERENCES locations(id),
+    detector_ref INTEGER REFERENCES detectors(id),
     record_time TIMESTAMP,
     duration FLOAT,
-    class_name TEXT,
+    class_ref INTEGER REFERENCES species(id),
     recording_night DATE,
     validated TEXT DEFAULT 'no',
     id_correct TEXT,
     comments TEXT,
     backup TEXT,
     backup_path TEXT,
-    record_path TEXT   
+    record_path TEXT,
+    content_hash TEXT,
+    archive_offset INTEGER,
+    archive_length INTEGER,
+    record_root_ref INTEGER REFERENCES storage_roots(id),
+    backup_root_ref INTEGER REFERENCES storage_roots(id)
 );
 """
 
 
 ANNOTATIONS = """
-CREATE TABLE IF NOT EXISTS annotations (
+CREATE TABLE IF NOT EXISTS annotation_data (
     id INTEGER PRIMARY KEY,
     record_id INTEGER,
     start_time FLOAT,
     end_time FLOAT,
     low_freq INTEGER,
     high_freq INTEGER,
-    spp_class TEXT,
+    species_ref INTEGER REFERENCES species(id),
     class_prob FLOAT,
     det_prob FLOAT,
     individual INTEGER,
-    event TEXT,
-    FOREIGN KEY (record_id) REFERENCES records(id) ON DELETE CASCADE
+    event_ref INTEGER REFERENCES events(id),
+    FOREIGN KEY (record_id) REFERENCES record_data(id) ON DELETE CASCADE
+);
+"""
+
+
+# Locations of audio files under storage roots, so moved files can be found without searching.
+# Paths are stored relative to their root so remapping a drive only changes `storage_roots`.
+# record_data paths are stored the same way when they fall under a root (`record_root_ref` and
+# `backup_root_ref`), and are absolute otherwise.
+STORAGE_ROOTS = """
+CREATE TABLE IF NOT EXISTS storage_roots (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL
+);
+"""
+
+
+FILE_INDEX = """
+CREATE TABLE IF NOT EXISTS file_index (
+    root_id INTEGER NOT NULL REFERENCES storage_roots(id) ON DELETE CASCADE,
+    rel_path TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    size INTEGER,
+    mtime FLOAT,
+    PRIMARY KEY (root_id, rel_path)
 );
 """
 
 
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS annotation_data_record_id ON annotation_data(record_id);",
+    "CREATE INDEX IF NOT EXISTS record_data_file_name ON record_data(file_name);",
+    "CREATE INDEX IF NOT EXISTS record_data_content_hash ON record_data(content_hash);",
+    "CREATE INDEX IF NOT EXISTS file_index_file_name ON file_index(file_name);",
+]
+
+
+# Views keep the original `records` and `annotations` column names so existing queries keep working.
+# They join every row to the lookup tables, large scans and aggregates should use the base tables.
+VIEWS = [
+    """
+CREATE VIEW IF NOT EXISTS records AS
+SELECT
+    r.id,
+    r.file_name,
+    l.name AS location_id,
+    d.name AS serial,
+    r.record_time,
+    r.duration,
+    s.name AS class_name,
+    r.recording_night,
+    r.validated,
+    r.id_correct,
+    r.comments,
+    r.backup,
+    CASE WHEN br.path IS NULL THEN r.backup_path ELSE br.path || '/' || r.backup_path END AS backup_path,
+    CASE WHEN rr.path IS NULL THEN r.record_path ELSE rr.path || '/' || r.record_path END AS record_path,
+    r.content_hash,
+    r.archive_offset,
+    r.archive_length
+FROM record_data r
+LEFT JOIN locations l ON l.id = r.location_ref
+LEFT JOIN detectors d ON d.id = r.detector_ref
+LEFT JOIN species s ON s.id = r.class_ref
+LEFT JOIN storage_roots rr ON rr.id = r.record_root_ref
+LEFT JOIN storage_roots br ON br.id = r.backup_root_ref;
+""",
+    """
+CREATE VIEW IF NOT EXISTS annotations AS
+SELECT
+    a.id,
+    a.record_id,
+    a.start_time,
+    a.end_time,
+    a.low_freq,
+    a.high_freq,
+    s.name AS spp_class,
+    a.class_prob,
+    a.det_prob,
+    a.individual,
+    e.name AS event
+FROM annotation_data a
+LEFT JOIN species s ON s.id = a.species_ref
+LEFT JOIN events e ON e.id = a.event_ref;
+""",
+]
+
+
+# Allow validation edits and deletes to be made against the views
+TRIGGERS = [
+    """
+CREATE TRIGGER IF NOT EXISTS records_update INSTEAD OF UPDATE ON records
+BEGIN
+    INSERT OR IGNORE INTO locations(name) SELECT NEW.location_id WHERE NEW.location_id IS NOT NULL;
+    INSERT OR IGNORE INTO detectors(name) SELECT NEW.serial WHERE NEW.serial IS NOT NULL;
+    INSERT OR IGNORE INTO species(name) SELECT NEW.class_name WHERE NEW.class_name IS NOT NULL;
+    UPDATE record_data SET
+        file_name = NEW.file_name,
+        location_ref = (SELECT id FROM locations WHERE name = NEW.location_id),
+        detector_ref = (SELECT id FROM detectors WHERE name = NEW.serial),
+        record_time = NEW.record_time,
+        duration = NEW.duration,
+        class_ref = (SELECT id FROM species WHERE name = NEW.class_name),
+        recording_night = NEW.recording_night,
+        validated = NEW.validated,
+        id_correct = NEW.id_correct,
+        comments = NEW.comments,
+        backup = NEW.backup,
+        -- paths set through the view are stored as given, i.e. absolute
+        backup_root_ref = CASE WHEN NEW.backup_path IS OLD.backup_path THEN backup_root_ref END,
+        backup_path = CASE WHEN NEW.backup_path IS OLD.backup_path THEN backup_path ELSE NEW.backup_path END,
+        record_root_ref = CASE WHEN NEW.record_path IS OLD.record_path THEN record_root_ref END,
+        record_path = CASE WHEN NEW.record_path IS OLD.record_path THEN record_path ELSE NEW.record_path END,
+        content_hash = NEW.content_hash,
+        archive_offset = NEW.archive_offset,
+        archive_length = NEW.archive_length
+    WHERE id = OLD.id;
+END;
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS records_delete INSTEAD OF DELETE ON records
+BEGIN
+    DELETE FROM record_data WHERE id = OLD.id;
+END;
+""",
+    """
+CREATE TRIGGER IF NOT EXISTS annotations_delete INSTEAD OF DELETE ON annotations
+BEGIN
+    DELETE FROM annotation_data WHERE id = OLD.id;
+END;
+""",
+]
+
+
+SCHEMA = [
+    *LOOKUPS,
+    RECORDS,
+    ANNOTATIONS,
+    STORAGE_ROOTS,
+    FILE_INDEX,
+    *INDEXES,
+    *VIEWS,
+    *TRIGGERS,
+]
+
+
+INSERT_RECORD = """INSERT INTO record_data(file_name, location_ref, detector_ref, record_time, duration, class_ref, recording_night, validated, id_correct, comments, backup, backup_path, record_path, content_hash, backup_root_ref, record_root_ref)
+                    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+INSERT_ANNOTATION = """
+                    INSERT INTO annotation_data(record_id, start_time, end_time, low_freq, high_freq, species_ref, class_prob, det_prob, individual, event_ref)
+                    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+
 def table_exists(dbpath: str = "./sqlite3.db") -> bool:
     with sqlite3.connect(dbpath) as conn:
         cur = conn.cursor()
@@ -50,7 +220,7 @@ def table_exists(dbpath: str = "./sqlite3.db") -> bool:
         cur.execute(
             """
             SELECT name FROM sqlite_master
-            WHERE type='table' AND name=?
+            WHERE type IN ('table', 'view') AND name=?
             """,
             ("records",),
         )
@@ -63,21 +233,254 @@ def table_exists(dbpath: str = "./sqlite3.db") -> bool:
 def create_schema(dbpath: str) -> None:
     with sqlite3.connect(dbpath) as conn:
         cur = conn.cursor()
-        cur.execute(RECORDS)
-        cur.execute(ANNOTATIONS)
+        for statement in SCHEMA:
+            cur.execute(statement)
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
         conn.commit()
 
 
-def record_exists(conn: sqlite3.Connection, record_id: str) -> bool:
+def lookup_id(conn: sqlite3.Connection, table: str, name: Optional[str]) -> Optional[int]:
+    """
+    Returns the id of `name` in a lookup table, adding it if it is not already present.
+
+    Args:
+        conn (sqlite3.Connection): Open database connection.
+        table (str): One of `LOOKUP_TABLES`.
+        name (str, optional): Value to look up, None is stored as NULL.
+
+    Returns:
+        Optional[int]: Row id in the lookup table or None if `name` is None.
+    """
+    if table not in LOOKUP_TABLES:
+        raise ValueError(f"{table} is not a lookup table")
+    if name is None:
+        return None
+
+    cur = conn.cursor()
+    cur.execute(f"INSERT OR IGNORE INTO {table}(name) VALUES (?)", (name,))
+    cur.execute(f"SELECT id FROM {table} WHERE name = ?", (name,))
+    row_id = cur.fetchone()[0]
+    cur.close()
+
+    return row_id
+
+
+def split_path(
+    conn: sqlite3.Connection, path: Optional[str]
+) -> Tuple[Optional[int], Optional[str]]:
+    """
+    Splits a path into the storage root it falls under and the path relative to that root.
+
+    Args:
+        conn (sqlite3.Connection): Open database connection.
+        path (str, optional): Absolute path to a file.
+
+    Returns:
+        Tuple[Optional[int], Optional[str]]: (root id, relative posix path) for the innermost
+                                             storage root containing `path`, or (None, path).
+    """
+    if path is None:
+        return None, None
+
+    best = None
+    for root_id, root in conn.execute("SELECT id, path FROM storage_roots"):
+        try:
+            rel_path = Path(path).relative_to(root)
+        except ValueError:
+            continue
+        if best is None or len(root) > best[2]:
+            best = (root_id, rel_path.as_posix(), len(root))
+
+    if best is None:
+        return None, str(path)
+    return best[0], best[1]
+
+
+def relativise_paths(conn: sqlite3.Connection, root_id: int, root: Path) -> int:
+    """
+    Rewrites absolute `record_path` and `backup_path` values under a storage root relative to it.
+    Changes are not committed, so this can run inside a schema upgrade.
+
+    Returns:
+        int: Number of paths rewritten.
+    """
+    updated = 0
+    for column in ("record_path", "backup_path"):
+        ref = column.replace("_path", "_root_ref")
+        rows = conn.execute(
+            f"SELECT id, {column} FROM record_data WHERE {ref} IS NULL AND {column} IS NOT NULL"
+        ).fetchall()
+        params = []
+        for record_id, path in rows:
+            try:
+                params.append((root_id, Path(path).relative_to(root).as_posix(), record_id))
+            except ValueError:
+                continue
+        conn.executemany(
+            f"UPDATE record_data SET {ref} = ?, {column} = ? WHERE id = ?", params
+        )
+        updated += len(params)
+    return updated
+
+
+def insert_record(conn: sqlite3.Connection, values: Tuple) -> Optional[int]:
+    """
+    Inserts a record given in `records` view column order (file_name ... content_hash),
+    replacing location_id, serial and class_name with lookup ids. Paths under a storage root
+    are stored relative to it.
+
+    Returns:
+        Optional[int]: id of the new record.
+    """
+    values = list(values)
+    values[1] = lookup_id(conn, "locations", values[1])
+    values[2] = lookup_id(conn, "detectors", values[2])
+    values[5] = lookup_id(conn, "species", values[5])
+    backup_root_ref, values[11] = split_path(conn, values[11])
+    record_root_ref, values[12] = split_path(conn, values[12])
+
+    return execute_query(
+        conn, INSERT_RECORD, (*values, backup_root_ref, record_root_ref)
+    )
+
+
+def set_record_path(conn: sqlite3.Connection, record_id: int, path: Path) -> None:
+    """
+    Stores a new location for a record's WAV file, e.g. after it was found through the file index.
+    """
+    root_ref, stored_path = split_path(conn, str(path))
+    execute_query(
+        conn,
+        "UPDATE record_data SET record_root_ref = ?, record_path = ? WHERE id = ?",
+        (root_ref, stored_path, record_id),
+    )
+
+
+def set_backup(
+    conn: sqlite3.Connection,
+    record_id: int,
+    backup_path: Path,
+    archive_offset: Optional[int] = None,
+    archive_length: Optional[int] = None,
+) -> None:
+    """
+    Marks a record as backed up and stores where the backup is, committing straight away.
+
+    Args:
+        record_id (int): id of the record.
+        backup_path (Path): FLAC file, or the per-night archive containing it.
+        archive_offset (int, optional): Byte offset of the FLAC data within the archive.
+        archive_length (int, optional): Length of the FLAC data within the archive.
+    """
+    root_ref, stored_path = split_path(conn, str(backup_path))
+    execute_query(
+        conn,
+        """
+        UPDATE record_data
+        SET backup = 'yes', backup_root_ref = ?, backup_path = ?, archive_offset = ?, archive_length = ?
+        WHERE id = ?
+        """,
+        (root_ref, stored_path, archive_offset, archive_length, record_id),
+    )
+
+
+def insert_annotations(conn: sqlite3.Connection, rows: List[Tuple]) -> None:
+    """
+    Inserts annotations given in `annotations` view column order (record_id ... event),
+    replacing spp_class and event with lookup ids.
+    """
+    rows = [
+        (
+            *row[:5],
+            lookup_id(conn, "species", row[5]),
+            *row[6:9],
+            lookup_id(conn, "events", row[9]),
+        )
+        for row in rows
+    ]
+
+    executemany_query(conn, INSERT_ANNOTATION, rows)
+
+
+def replace_results(
+    conn: sqlite3.Connection,
+    record_id: int,
+    duration: float,
+    class_name: Optional[str],
+    rows: List[Tuple],
+) -> None:
+    """
+    Replaces the BatDetect2 results of an existing record, e.g. after re-analysing a backup.
+    Paths and the content hash are left unchanged. If the predicted class changes, any
+    validation of the old class no longer applies, so `validated` is reset and `id_correct`
+    cleared.
+
+    Args:
+        record_id (int): id of the record.
+        duration (float): Duration of the analysed audio in seconds.
+        class_name (str, optional): Predicted species for the whole recording.
+        rows (List[Tuple]): New annotations in `annotations` view column order.
+    """
     cur = conn.cursor()
+    class_ref = lookup_id(conn, "species", class_name)
     cur.execute(
-        "select exists (select file_name from records where file_name = ?)",
+        "SELECT r.file_name, s.name, r.validated, r.class_ref FROM record_data r LEFT JOIN species s ON s.id = r.class_ref WHERE r.id = ?",
         (record_id,),
     )
-    exists = cur.fetchone()[0]
+    file_name, old_class, validated, old_class_ref = cur.fetchone()
+
+    if class_ref != old_class_ref:
+        if validated not in (None, "no"):
+            logging.warning(
+                f"{file_name} class changed from {old_class} to {class_name}, validation reset"
+            )
+        cur.execute(
+            "UPDATE record_data SET validated = 'no', id_correct = NULL WHERE id = ?",
+            (record_id,),
+        )
+    cur.execute(
+        "UPDATE record_data SET duration = ?, class_ref = ? WHERE id = ?",
+        (duration, class_ref, record_id),
+    )
+    cur.execute("DELETE FROM annotation_data WHERE record_id = ?", (record_id,))
+    cur.close()
+
+    if rows:
+        insert_annotations(conn, rows)
+    conn.commit()
+
+
+def find_record_by_hash(conn: sqlite3.Connection, content_hash: str) -> Optional[str]:
+    """
+    Returns the file name of a record with the given audio fingerprint, or None.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "select file_name from record_data where content_hash = ? limit 1",
+        (content_hash,),
+    )
+    row = cur.fetchone()
+    cur.close()
+
+    return row[0] if row else None
+
+
+def find_records_by_name(
+    conn: sqlite3.Connection, file_name: str
+) -> List[Tuple[int, Optional[str]]]:
+    """
+    Returns (id, content_hash) for every record with the given file name.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "select id, content_hash from record_data where file_name = ?",
+        (file_name,),
+    )
+    rows = cur.fetchall()
+    cur.close()
 
-    return exists
+    return rows
 
 
 def executemany_query(
@@ -0,0 +1,226 @@
+import logging
+import mmap
+import sqlite3
+import wave
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+from matplotlib import colormaps
+from PIL import Image
+from bat_acoustic_tools.db.migrate import require_current_schema
+from bat_acoustic_tools.file_index import Source, find_source
+from bat_acoustic_tools.utils import (
+    ArchivedFile,
+    find_wav_data_chunk,
+    read_wav_format,
+    setup_logging,
+)
+
+"""
+Extract short clips and spectrogram thumbnails of individual calls for validation.
+
+Each selected annotation is cut from its source recording using `start_time` / `end_time`:
+
+- WAV files still on disk are memory-mapped and sliced, only the pages for each call are read
+- FLAC backups are opened with libsndfile, which seeks using the FLAC seek table
+- FLAC files inside a per-night archive are read in place using `archive_offset` / `archive_length`
+
+Recordings are processed in parallel, each worker opening one recording and writing all of its calls.
+"""
+
+CALLS_QUERY = """
+SELECT a.id, a.record_id, a.start_time, a.end_time, a.spp_class,
+       r.file_name, r.record_path, r.backup_path, r.archive_offset, r.archive_length, r.content_hash
+FROM annotations a
+JOIN records r ON r.id = a.record_id
+WHERE a.id IN ({sql})
+ORDER BY a.record_id, a.start_time
+"""
+
+# spectrogram settings, frequency range covers UK bat calls
+N_FFT = 512
+HOP_LENGTH = 128
+SPEC_MIN_FREQ = 10000
+SPEC_MAX_FREQ = 130000
+SPEC_DYNAMIC_RANGE = 80
+# 256 colour lookup table, indexing it is much quicker than matplotlib's colour mapping
+COLOUR_MAP = (colormaps["magma"](np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
+
+# (annotation id, start time, end time, species)
+Call = Tuple[int, float, float, Optional[str]]
+
+
+def _read_wav_segments(path: str, segments: List[Tuple[float, float]]):
+    with open(path, "rb") as f:
+        channels, sample_rate, bits = read_wav_format(f)
+        data_offset, data_length = find_wav_data_chunk(f)
+        if bits != 16:
+            raise ValueError(f"{path} is {bits} bit, only 16 bit WAV files are supported")
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            samples = np.frombuffer(
+                mapped,
+                dtype="<i2",
+                count=data_length // (2 * channels) * channels,
+                offset=data_offset,
+            ).reshape(-1, channels)[:, 0]
+            # copy each call out of the map, the view must be released before the map is closed
+            clips = [
+                samples[int(start * sample_rate) : int(end * sample_rate)].copy()
+                for start, end in segments
+            ]
+            del samples
+
+    return sample_rate, clips
+
+
+def _read_sndfile_segments(file, segments: List[Tuple[float, float]]):
+    with sf.SoundFile(file) as snd:
+        sample_rate = snd.samplerate
+        clips = []
+        for start, end in segments:
+            first, last = int(start * sample_rate), int(end * sample_rate)
+            snd.seek(min(first, snd.frames))
+            audio = snd.read(last - first, dtype="int16", always_2d=True)
+            clips.append(audio[:, 0])
+        return sample_rate, clips
+
+
+def read_segments(source: Source, segments: List[Tuple[float, float]]):
+    """
+    Reads time segments (in seconds) from a recording.
+
+    Returns:
+        tuple: (sample rate, list of int16 arrays, one per segment)
+    """
+    kind = source[0]
+    if kind == "wav":
+        return _read_wav_segments(source[1], segments)
+    if kind == "archive":
+        with ArchivedFile(Path(source[1]), source[2], source[3]) as member:
+            return _read_sndfile_segments(member, segments)
+    return _read_sndfile_segments(source[1], segments)
+
+
+def write_clip(audio: np.ndarray, sample_rate: int, clip_path: Path) -> None:
+    with wave.open(str(clip_path), "wb") as clip:
+        clip.setnchannels(1)
+        clip.setsampwidth(2)
+        clip.setframerate(sample_rate)
+        clip.writeframes(audio.astype("<i2").tobytes())
+
+
+def spectrogram(audio: np.ndarray, sample_rate: int) -> np.ndarray:
+    """
+    Returns a log magnitude spectrogram (dB) of a clip, low frequencies at the bottom.
+    """
+    audio = audio.astype(np.float32) / 32768
+    if len(audio) < N_FFT:
+        audio = np.pad(audio, (0, N_FFT - len(audio)))
+    frames = np.lib.stride_tricks.sliding_window_view(audio, N_FFT)[::HOP_LENGTH]
+    magnitude = np.abs(np.fft.rfft(frames * np.hanning(N_FFT), axis=1)).T
+
+    freqs = np.fft.rfftfreq(N_FFT, 1 / sample_rate)
+    in_range = (freqs >= SPEC_MIN_FREQ) & (freqs <= SPEC_MAX_FREQ)
+
+    return np.flipud(20 * np.log10(magnitude[in_range] + 1e-6))
+
+
+def write_spectrogram(audio: np.ndarray, sample_rate: int, png_path: Path) -> None:
+    spec = spectrogram(audio, sample_rate)
+    floor = spec.max() - SPEC_DYNAMIC_RANGE
+    levels = np.clip((spec - floor) / SPEC_DYNAMIC_RANGE * 255, 0, 255).astype(np.uint8)
+    # low compression, thumbnails are small and written in bulk
+    Image.fromarray(COLOUR_MAP[levels]).save(png_path, compress_level=1)
+
+
+def extract_record(
+    source: Source,
+    file_name: str,
+    calls: List[Call],
+    output_dir: Path,
+    padding: float,
+    clips: bool,
+    spectrograms: bool,
+) -> int:
+    """
+    Writes clips and/or spectrograms for all selected calls in one recording.
+
+    Returns:
+        int: Number of calls extracted.
+    """
+    segments = [(max(start - padding, 0), end + padding) for _, start, end, _ in calls]
+    sample_rate, audio_segments = read_segments(source, segments)
+
+    stem = Path(file_name).stem
+    for (annotation_id, _, _, spp_class), audio in zip(calls, audio_segments):
+        species = (spp_class or "unknown").replace(" ", "_")
+        name = f"{stem}_{annotation_id}_{species}"
+        if clips:
+            write_clip(audio, sample_rate, output_dir / f"{name}.wav")
+        if spectrograms:
+            write_spectrogram(audio, sample_rate, output_dir / f"{name}.png")
+
+    return len(calls)
+
+
+def main(
+    db_path: Path,
+    output_dir: Path,
+    sql_query: str,
+    padding: float = 0.02,
+    clips: bool = True,
+    spectrograms: bool = True,
+    workers: Optional[int] = None,
+):
+    setup_logging()
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    records = {}
+    record_calls = defaultdict(list)
+    with sqlite3.connect(db_path) as conn:
+        require_current_schema(conn)
+        rows = conn.execute(CALLS_QUERY.format(sql=sql_query)).fetchall()
+        logging.info(f"{len(rows)} calls to extract")
+
+        for (annotation_id, record_id, start_time, end_time, spp_class, file_name,
+             record_path, backup_path, archive_offset, archive_length, content_hash) in rows:
+            if record_id not in records:
+                source = find_source(
+                    conn, record_id, file_name, record_path, backup_path,
+                    archive_offset, archive_length, content_hash,
+                )
+                if source is None:
+                    logging.warning(f"{file_name} not found, skipping its calls")
+                records[record_id] = (source, file_name)
+            if records[record_id][0] is not None:
+                record_calls[record_id].append((annotation_id, start_time, end_time, spp_class))
+
+    extracted = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                extract_record,
+                *records[record_id],
+                calls,
+                output_dir,
+                padding,
+                clips,
+                spectrograms,
+            ): record_id
+            for record_id, calls in record_calls.items()
+        }
+        for future in as_completed(futures):
+            file_name = records[futures[future]][1]
+            try:
+                extracted += future.result()
+            except Exception as e:
+                logging.error(f"Error extracting calls from {file_name}: {e}")
+                continue
+            logging.info(f"{extracted} of {len(rows)} calls extracted")
+
+    logging.info(f"Extraction complete, {extracted} calls written to {output_dir}")
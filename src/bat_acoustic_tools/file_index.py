@@ -0,0 +1,271 @@
+import logging
+import os
+import sqlite3
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+from bat_acoustic_tools.db.migrate import require_current_schema
+from bat_acoustic_tools.db.utils import relativise_paths, set_backup, set_record_path
+from bat_acoustic_tools.utils import ArchivedFile, audio_fingerprint, decoded_fingerprint
+
+"""
+Persistent index of audio files under one or more storage roots.
+
+`reindex` walks each root once and stores file_name -> (root, relative path, size, mtime) in the
+`file_index` table. Record paths under an indexed root are stored relative to it too, so a drive
+that has been remounted elsewhere is remapped with a single UPDATE of `storage_roots`.
+
+Files whose `record_path` or `backup_path` is stale (cards moved, drive letters changed) can be
+found with an indexed lookup instead of searching the drive. File names are not unique across
+detectors, so a file found by name is only used once its audio matches the record's
+`content_hash`, and the record's path is then updated so the next lookup is direct.
+"""
+
+INDEXED_EXTENSIONS = (".wav", ".flac", ".tar")
+INSERT_BATCH_SIZE = 10000
+
+# where to read a recording from: ("wav" | "flac", path) or ("archive", path, offset, length)
+Source = Tuple
+
+
+def _scan_directory(
+    directory: str, extensions: Tuple[str, ...]
+) -> Tuple[List[Tuple[str, str, int, float]], List[str]]:
+    files = []
+    subdirectories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.name.lower().endswith(extensions):
+                    stat = entry.stat()
+                    files.append((entry.path, entry.name, stat.st_size, stat.st_mtime))
+    except (FileNotFoundError, PermissionError) as e:
+        logging.warning(f"Unable to scan {directory}: {e}")
+    return files, subdirectories
+
+
+def scan_root(
+    root: Path,
+    extensions: Tuple[str, ...] = INDEXED_EXTENSIONS,
+    workers: int = 8,
+) -> Iterator[Tuple[str, str, int, float]]:
+    """
+    Walks a directory tree, scanning directories in parallel with os.scandir.
+
+    Args:
+        root (Path): Directory to walk.
+        extensions (tuple): Lower case file extensions to include.
+        workers (int): Number of directories scanned at once, helps most on network and USB drives.
+
+    Returns:
+        Iterator[tuple]: (path relative to root, file name, size, mtime) for each matching file.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(_scan_directory, str(root), extensions)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirectories = future.result()
+                for subdirectory in subdirectories:
+                    pending.add(executor.submit(_scan_directory, subdirectory, extensions))
+                for path, name, size, mtime in files:
+                    yield Path(os.path.relpath(path, root)).as_posix(), name, size, mtime
+
+
+def root_id(conn: sqlite3.Connection, root: Path) -> int:
+    cur = conn.cursor()
+    cur.execute("INSERT OR IGNORE INTO storage_roots(path) VALUES (?)", (str(root),))
+    cur.execute("SELECT id FROM storage_roots WHERE path = ?", (str(root),))
+    return cur.fetchone()[0]
+
+
+def reindex(
+    db_path: Path,
+    roots: List[Path],
+    workers: int = 8,
+    extensions: Tuple[str, ...] = INDEXED_EXTENSIONS,
+) -> None:
+    """
+    Rebuilds the file index for each storage root.
+
+    Args:
+        db_path (Path): Path to the sqlite3 database.
+        roots (List[Path]): Storage roots to walk, e.g. the deployments and backup directories.
+        workers (int): Number of directories scanned at once.
+        extensions (tuple): Lower case file extensions to include.
+    """
+    with sqlite3.connect(db_path) as conn:
+        require_current_schema(conn)
+        for root in roots:
+            logging.info(f"Indexing {root}")
+            rid = root_id(conn, root)
+            conn.execute("DELETE FROM file_index WHERE root_id = ?", (rid,))
+
+            count = 0
+            batch = []
+            for rel_path, name, size, mtime in scan_root(root, extensions, workers):
+                batch.append((rid, rel_path, name, size, mtime))
+                if len(batch) >= INSERT_BATCH_SIZE:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO file_index(root_id, rel_path, file_name, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                        batch,
+                    )
+                    count += len(batch)
+                    batch = []
+                    logging.info(f"{count} files indexed")
+            conn.executemany(
+                "INSERT OR REPLACE INTO file_index(root_id, rel_path, file_name, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                batch,
+            )
+            count += len(batch)
+
+            relativised = relativise_paths(conn, rid, root)
+
+            # old index for the root is only replaced once the walk has finished
+            conn.commit()
+            logging.info(f"{count} files indexed under {root}")
+            if relativised:
+                logging.info(f"{relativised} record paths now stored relative to {root}")
+
+
+def indexed_paths(conn: sqlite3.Connection, file_name: str) -> List[Path]:
+    """
+    Returns every indexed location of a file name that still exists.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        """
+        SELECT r.path, f.rel_path FROM file_index f
+        JOIN storage_roots r ON r.id = f.root_id
+        WHERE f.file_name = ?
+        """,
+        (file_name,),
+    )
+    return [
+        Path(root) / rel_path
+        for root, rel_path in cur.fetchall()
+        if (Path(root) / rel_path).exists()
+    ]
+
+
+def _fingerprint(source: Source) -> Optional[str]:
+    try:
+        if source[0] == "wav":
+            return audio_fingerprint(Path(source[1]))
+        if source[0] == "archive":
+            with ArchivedFile(Path(source[1]), source[2], source[3]) as member:
+                return decoded_fingerprint(member)
+        return decoded_fingerprint(source[1])
+    except Exception as e:
+        logging.warning(f"Unable to read {source[1]}: {e}")
+        return None
+
+
+def resolve_file(
+    conn: sqlite3.Connection, file_name: str, content_hash: Optional[str]
+) -> Optional[Path]:
+    """
+    Looks up a file by name in the file index, only accepting a file whose audio matches.
+
+    Args:
+        conn (sqlite3.Connection): Open database connection.
+        file_name (str): WAV or FLAC file name, e.g. SMU01770-2_20240416_022448.wav.
+        content_hash (str, optional): `content_hash` of the record the file should belong to.
+                                      Records without one cannot be checked and are not resolved.
+
+    Returns:
+        Optional[Path]: Indexed location of the file with matching audio, or None.
+    """
+    candidates = indexed_paths(conn, file_name)
+    if not candidates:
+        return None
+    if content_hash is None:
+        logging.warning(
+            f"{file_name} has no content_hash to check against, not using {candidates[0]}"
+        )
+        return None
+
+    kind = "wav" if Path(file_name).suffix.lower() == ".wav" else "flac"
+    for candidate in candidates:
+        if _fingerprint((kind, str(candidate))) == content_hash:
+            return candidate
+        logging.warning(f"{candidate} has different audio to the {file_name} record, ignoring it")
+    return None
+
+
+def remap_root(conn: sqlite3.Connection, old_root: Path, new_root: Path) -> int:
+    """
+    Points an indexed storage root at a new location, e.g. when a drive letter changes.
+
+    If the new location is already a storage root, e.g. it was reindexed first, the old root is
+    merged into it, keeping the new root's index entries for files indexed under both.
+
+    Returns:
+        int: Number of roots updated.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM storage_roots WHERE path = ?", (str(old_root),))
+    old = cur.fetchone()
+    if old is None:
+        return 0
+    cur.execute("SELECT id FROM storage_roots WHERE path = ?", (str(new_root),))
+    new = cur.fetchone()
+
+    if new is None:
+        cur.execute("UPDATE storage_roots SET path = ? WHERE id = ?", (str(new_root), old[0]))
+    elif new[0] != old[0]:
+        logging.info(f"{new_root} is already indexed, merging {old_root} into it")
+        for statement in [
+            "UPDATE record_data SET record_root_ref = ? WHERE record_root_ref = ?",
+            "UPDATE record_data SET backup_root_ref = ? WHERE backup_root_ref = ?",
+            "UPDATE OR IGNORE file_index SET root_id = ? WHERE root_id = ?",
+        ]:
+            cur.execute(statement, (new[0], old[0]))
+        cur.execute("DELETE FROM file_index WHERE root_id = ?", (old[0],))
+        cur.execute("DELETE FROM storage_roots WHERE id = ?", (old[0],))
+    conn.commit()
+    return 1
+
+
+def find_source(
+    conn: sqlite3.Connection,
+    record_id: int,
+    file_name: str,
+    record_path: Optional[str],
+    backup_path: Optional[str],
+    archive_offset: Optional[int],
+    archive_length: Optional[int],
+    content_hash: Optional[str],
+) -> Optional[Source]:
+    """
+    Picks where to read a recording from, preferring the original WAV over a backup and
+    falling back to the file index when stored paths are stale. A file found through the index
+    must match `content_hash`, and its location is then stored on the record.
+    """
+    if record_path and Path(record_path).exists():
+        return ("wav", record_path)
+    if backup_path and Path(backup_path).exists():
+        if archive_offset is not None:
+            return ("archive", backup_path, archive_offset, archive_length)
+        return ("flac", backup_path)
+
+    if archive_offset is None:
+        resolved = resolve_file(conn, file_name, content_hash)
+        if resolved is not None:
+            set_record_path(conn, record_id, resolved)
+            return ("wav", str(resolved))
+        resolved = resolve_file(conn, Path(file_name).stem + ".flac", content_hash)
+        if resolved is not None:
+            set_backup(conn, record_id, resolved)
+            return ("flac", str(resolved))
+    elif backup_path and content_hash is not None:
+        # per-night archive names repeat across locations, check the member at the stored offset
+        for archive_path in indexed_paths(conn, Path(backup_path).name):
+            source = ("archive", str(archive_path), archive_offset, archive_length)
+            if _fingerprint(source) == content_hash:
+                set_backup(conn, record_id, archive_path, archive_offset, archive_length)
+                return source
+
+    return None
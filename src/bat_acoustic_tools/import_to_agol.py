@@ -91,7 +91,7 @@ def main():
     logging.info("Deployment dictionary generated")
 
     with sqlite3.connect("./sqlite3.db") as conn:
-        loc_query = "SELECT serial FROM records GROUP BY serial"
+        loc_query = "SELECT d.id, d.name FROM detectors d WHERE d.id IN (SELECT DISTINCT detector_ref FROM record_data)"
 
         cursor = conn.cursor()
 
@@ -103,17 +103,19 @@ def main():
 
         features = []
 
-        for serial_number in serial_numbers:
-            sn = serial_number[0]
+        for detector_ref, sn in serial_numbers:
             logging.info(f"{sn}")
 
             cursor = conn.cursor()
 
             cursor.execute(
                 """
-                        SELECT record_time, file_name, duration, recording_night, class_name, location_id  FROM records WHERE serial = ? AND class_name <> 'None'
+                        SELECT r.record_time, r.file_name, r.duration, r.recording_night, s.name, l.name FROM record_data r
+                        JOIN species s ON s.id = r.class_ref
+                        LEFT JOIN locations l ON l.id = r.location_ref
+                        WHERE r.detector_ref = ? AND s.name <> 'None'
                         """,
-                (sn,),
+                (detector_ref,),
             )
             records = cursor.fetchall()
 
@@ -0,0 +1,333 @@
+import inspect
+import logging
+import os
+import tempfile
+import time
+from enum import Enum
+from importlib.metadata import version
+from importlib.util import find_spec
+from pathlib import Path
+from typing import Dict, List
+
+import librosa
+import numpy as np
+import torch
+from batdetect2 import api
+from batdetect2.detector import compute_features as feats
+from batdetect2.types import ModelOutput
+from batdetect2.utils import detector_utils as du
+
+"""
+Inference backends for BatDetect2.
+
+BatDetect2 only calls the detection model as `model(spec)` and reads a few attributes from it,
+so an exported copy of the same network can be dropped in through the `model` argument of
+`api.process_file`. All pre- and post-processing stays in BatDetect2.
+
+- pytorch: the stock model
+- torchscript: the model traced and frozen with TorchScript
+- onnx: the model exported to ONNX and run with ONNX Runtime, optionally int8 quantised
+"""
+
+CPU = torch.device("cpu")
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "bat_acoustic_tools"
+
+# spectrogram widths used to export and check the traced model, chunk widths vary with file length
+EXAMPLE_WIDTHS = (512, 1024)
+
+
+class Backend(str, Enum):
+    pytorch = "pytorch"
+    torchscript = "torchscript"
+    onnx = "onnx"
+
+
+# (backend, quantize) pairs timed by the `benchmark` command
+BENCHMARK_BACKENDS = [
+    (Backend.pytorch, False),
+    (Backend.torchscript, False),
+    (Backend.onnx, False),
+    (Backend.onnx, True),
+]
+
+
+def backend_available(backend: Backend) -> bool:
+    """
+    Returns False if the optional packages a backend needs are not installed.
+    """
+    if Backend(backend) is Backend.onnx:
+        return all(find_spec(name) is not None for name in ("onnx", "onnxruntime"))
+    return True
+
+
+class ExportedModel:
+    """
+    Wraps an exported network so it can be passed to BatDetect2 in place of the PyTorch model.
+
+    Attribute lookups not handled here (e.g. `num_classes`, `resize_factor`) are passed to the
+    original model.
+    """
+
+    def __init__(self, source_model, run):
+        self.source_model = source_model
+        self.run = run
+
+    def __call__(self, ip: torch.Tensor, *args, **kwargs) -> ModelOutput:
+        return ModelOutput(*self.run(ip.to(CPU)))
+
+    def __getattr__(self, name):
+        return getattr(self.source_model, name)
+
+
+class InferenceBackend:
+    """
+    A loaded BatDetect2 model and the device it runs on.
+    """
+
+    def __init__(self, name: str, model, device: torch.device):
+        self.name = name
+        self.model = model
+        self.device = device
+
+    def process_file(self, audio_file: str, config) -> dict:
+        return api.process_file(
+            audio_file, model=self.model, config=config, device=self.device
+        )
+
+    def process_audio(
+        self, audio: np.ndarray, sampling_rate: int, file_id: str, config
+    ) -> dict:
+        """
+        Equivalent of `process_file` for audio that has already been decoded, e.g. from a FLAC
+        backup inside an archive. Follows `batdetect2.utils.detector_utils.process_file`
+        (batdetect2 1.0.8) after its audio loading step, so results match a WAV of the same audio.
+
+        Args:
+            audio (np.ndarray): Mono float32 samples as returned by soundfile/librosa.
+            sampling_rate (int): Sample rate of `audio`.
+            file_id (str): Value for the `id` of the results, normally the WAV file name.
+            config: BatDetect2 processing configuration.
+
+        Returns:
+            dict: Results in the same format as `api.process_file`.
+        """
+        time_exp = config.get("time_expansion", 1) or 1
+        orig_samp_rate = sampling_rate * time_exp
+        audio, sampling_rate = _preprocess_audio(audio, orig_samp_rate, config)
+
+        predictions = []
+        spec_feats = []
+        cnn_feats = []
+        spec_slices = []
+        for chunk_time, chunk in du.iterate_over_chunks(
+            audio, sampling_rate, config["chunk_size"]
+        ):
+            pred_nms, features, spec = du._process_audio_array(
+                chunk, sampling_rate, self.model, config, self.device
+            )
+            spec_np = spec.detach().cpu().numpy().squeeze()
+            pred_nms["start_times"] += chunk_time
+            pred_nms["end_times"] += chunk_time
+            predictions.append(pred_nms)
+
+            if pred_nms["det_probs"].shape[0] == 0:
+                continue
+            if config["spec_features"]:
+                spec_feats.append(feats.get_feats(spec_np, pred_nms, config))
+            if config["cnn_features"]:
+                cnn_feats.append(features[0])
+            if config["spec_slices"]:
+                spec_slices.extend(feats.extract_spec_slices(spec_np, pred_nms))
+
+        predictions, spec_feats, cnn_feats, spec_slices = du._merge_results(
+            predictions, spec_feats, cnn_feats, spec_slices
+        )
+
+        return du.convert_results(
+            file_id=file_id,
+            time_exp=time_exp,
+            duration=audio.shape[0] / float(sampling_rate),
+            params=config,
+            predictions=predictions,
+            spec_feats=spec_feats,
+            cnn_feats=cnn_feats,
+            spec_slices=spec_slices,
+            nyquist_freq=orig_samp_rate / 2,
+        )
+
+
+def _preprocess_audio(audio: np.ndarray, sampling_rate: float, config):
+    # same steps as batdetect2.utils.audio_utils.load_audio after reading the file
+    target_samp_rate = config["target_samp_rate"]
+    if sampling_rate != target_samp_rate:
+        audio = librosa.resample(
+            audio, orig_sr=sampling_rate, target_sr=target_samp_rate, res_type="polyphase"
+        )
+
+    max_duration = config.get("max_duration")
+    if max_duration is not None:
+        audio = audio[: min(int(target_samp_rate * max_duration), audio.shape[0])]
+
+    if config["scale_raw_audio"]:
+        audio = audio - audio.mean()
+        audio = audio / (np.abs(audio).max() + 10e-6)
+
+    return audio, target_samp_rate
+
+
+def _example_input(model, width: int) -> torch.Tensor:
+    return torch.rand(1, 1, model.ip_height_rs, width)
+
+
+def _trace(model) -> torch.jit.ScriptModule:
+    examples = [(_example_input(model, width),) for width in EXAMPLE_WIDTHS]
+    with torch.no_grad():
+        # check_inputs raises if the trace does not generalise to other widths
+        traced = torch.jit.trace(model, examples[0], check_inputs=examples[1:])
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+
+def _temp_path(onnx_path: Path) -> Path:
+    fd, name = tempfile.mkstemp(
+        dir=onnx_path.parent, prefix=f"{onnx_path.stem}.", suffix=".tmp.onnx"
+    )
+    os.close(fd)
+    return Path(name)
+
+
+def _export_onnx(model, onnx_path: Path, quantize: bool) -> None:
+    output_names = list(ModelOutput._fields)
+    dynamic_axes = {name: {3: "width"} for name in ["spec", *output_names]}
+
+    # newer torch defaults to the torch.export based exporter, which also needs onnxscript
+    exporter = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        exporter["dynamo"] = False
+
+    # written under unique names and moved into place once complete, so an interrupted or
+    # concurrent export never leaves a partial model at onnx_path
+    export_path = _temp_path(onnx_path)
+    quantized_path = _temp_path(onnx_path) if quantize else export_path
+    try:
+        logging.info(f"Exporting BatDetect2 model to {onnx_path}")
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                (_example_input(model, EXAMPLE_WIDTHS[0]),),
+                str(export_path),
+                input_names=["spec"],
+                output_names=output_names,
+                dynamic_axes=dynamic_axes,
+                opset_version=17,
+                **exporter,
+            )
+
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            logging.info("Quantising exported model")
+            quantize_dynamic(
+                str(export_path), str(quantized_path), weight_type=QuantType.QInt8
+            )
+
+        os.replace(quantized_path, onnx_path)
+    finally:
+        export_path.unlink(missing_ok=True)
+        quantized_path.unlink(missing_ok=True)
+
+
+def _onnx_session(onnx_path: Path):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = (
+        onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    )
+    return onnxruntime.InferenceSession(
+        str(onnx_path), options, providers=["CPUExecutionProvider"]
+    )
+
+
+def check_backend(backend: Backend, quantize: bool) -> Backend:
+    """
+    Raises ValueError for backend options that cannot be loaded, before any model is loaded.
+    """
+    backend = Backend(backend)
+    if quantize and backend is not Backend.onnx:
+        raise ValueError(
+            f"int8 quantisation is not supported by the {backend.value} backend, use onnx"
+        )
+    return backend
+
+
+def load_backend(
+    backend: Backend = Backend.pytorch,
+    quantize: bool = False,
+    cache_dir: Path = DEFAULT_CACHE_DIR,
+) -> InferenceBackend:
+    """
+    Loads the default BatDetect2 model for the given backend.
+
+    Args:
+        backend (Backend): Inference backend to use.
+        quantize (bool): Use int8 weights, only supported by the onnx backend. BatDetect2 reads the
+                         weights of its attention layers directly, which fails once PyTorch has
+                         quantised them, and its remaining layers are convolutions.
+        cache_dir (Path): Directory exported ONNX models are stored in, they are
+                          reused until the installed BatDetect2 version changes.
+
+    Returns:
+        InferenceBackend: Backend ready to be passed to `process_wavs`.
+    """
+    backend = check_backend(backend, quantize)
+    name = backend.value + ("-int8" if quantize else "")
+
+    if backend is Backend.pytorch:
+        model, _ = api.load_model()
+        return InferenceBackend(name, model, api.DEVICE)
+
+    model, _ = api.load_model(device=CPU)
+    model.eval()
+
+    if backend is Backend.torchscript:
+        traced = _trace(model)
+
+        def run(ip):
+            with torch.no_grad():
+                return traced(ip)
+
+        return InferenceBackend(name, ExportedModel(model, run), CPU)
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    onnx_path = cache_dir / f"batdetect2-{version('batdetect2')}-{name}.onnx"
+    if not onnx_path.exists():
+        _export_onnx(model, onnx_path, quantize)
+    session = _onnx_session(onnx_path)
+
+    def run(ip):
+        outputs = session.run(None, {"spec": ip.numpy()})
+        return [torch.from_numpy(output) for output in outputs]
+
+    return InferenceBackend(name, ExportedModel(model, run), CPU)
+
+
+def benchmark(
+    backends: List[InferenceBackend], audio_files: List[str], config
+) -> Dict[str, float]:
+    """
+    Times each backend over the same files.
+
+    Returns:
+        Dict[str, float]: Files per second for each backend name.
+    """
+    results = {}
+    for backend in backends:
+        # first call includes one-off setup costs
+        backend.process_file(audio_files[0], config)
+        start = time.perf_counter()
+        for audio_file in audio_files:
+            backend.process_file(audio_file, config)
+        elapsed = time.perf_counter() - start
+        results[backend.name] = len(audio_files) / elapsed
+        logging.info(f"{backend.name}: {results[backend.name]:.2f} files/sec")
+    return results
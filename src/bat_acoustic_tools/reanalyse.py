@@ -0,0 +1,147 @@
+import logging
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+import torch
+from bat_acoustic_tools.db.utils import replace_results
+from bat_acoustic_tools.file_index import Source, find_source
+from bat_acoustic_tools.inference import Backend, load_backend
+from bat_acoustic_tools.process_wavs import annotation_rows, get_config, prepare_database
+from bat_acoustic_tools.utils import ArchivedFile, setup_logging
+
+"""
+Re-run BatDetect2 over recordings already in the database, e.g. with a new model or threshold.
+
+Recordings whose WAV has been deleted are read from their FLAC backup, either a standalone file or
+a member of a per-night archive. FLAC is decoded with libsndfile straight into one float32 buffer
+that is passed to the detector, nothing is written to disk.
+
+Recordings are decoded and analysed in worker processes, each with its own copy of the model. The
+main process is the only database writer and replaces each record's results as they arrive.
+"""
+
+RECORDS_QUERY = """
+SELECT id, file_name, record_path, backup_path, archive_offset, archive_length, content_hash
+FROM records
+WHERE id IN ({sql})
+ORDER BY id
+"""
+
+# model and configuration loaded once per worker process by `_init_worker`
+_inference = None
+_config = None
+
+
+def _decode(file) -> Tuple[np.ndarray, int]:
+    with sf.SoundFile(file) as snd:
+        if snd.channels > 1:
+            raise ValueError("Currently does not handle stereo files")
+        # same samples as librosa.load(sr=None, dtype=np.float32), decoded in place
+        audio = np.empty(snd.frames, dtype=np.float32)
+        frames_read = len(snd.read(out=audio))
+        return audio[:frames_read], snd.samplerate
+
+
+def decode_audio(source: Source) -> Tuple[np.ndarray, int]:
+    """
+    Decodes a WAV, FLAC or archived FLAC recording to mono float32 samples.
+
+    Returns:
+        tuple: (samples, sample rate)
+    """
+    if source[0] == "archive":
+        with ArchivedFile(Path(source[1]), source[2], source[3]) as member:
+            return _decode(member)
+    return _decode(source[1])
+
+
+def _init_worker(backend: Backend, quantize: bool, threshold: float, threads: int) -> None:
+    global _inference, _config
+    # share the CPUs between workers rather than each using all of them
+    torch.set_num_threads(threads)
+    _inference = load_backend(backend, quantize)
+    _config = get_config(threshold)
+
+
+def reanalyse_record(record_id: int, file_name: str, source: Source) -> Tuple[int, dict]:
+    """
+    Runs BatDetect2 over one recording in a worker process.
+
+    Returns:
+        tuple: (record id, BatDetect2 `pred_dict`)
+    """
+    audio, sample_rate = decode_audio(source)
+    processed = _inference.process_audio(audio, sample_rate, file_name, _config)
+    return record_id, processed["pred_dict"]
+
+
+def main(
+    db_path: Path,
+    sql_query: str,
+    threshold: float,
+    backend: Backend = Backend.pytorch,
+    quantize: bool = False,
+    workers: Optional[int] = None,
+):
+    setup_logging()
+    # fail here rather than in every worker's initializer, and build any cached export once so
+    # workers only read it
+    load_backend(backend, quantize)
+    prepare_database(db_path)
+
+    workers = workers or os.cpu_count() or 1
+    threads = max(1, (os.cpu_count() or 1) // workers)
+
+    records = []
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute(RECORDS_QUERY.format(sql=sql_query)).fetchall()
+        for record_id, file_name, *paths, content_hash in rows:
+            source = find_source(conn, record_id, file_name, *paths, content_hash)
+            if source is None:
+                logging.warning(f"{file_name} not found, skipping")
+                continue
+            records.append((record_id, file_name, source))
+
+        logging.info(f"{len(records)} of {len(rows)} records to re-analyse")
+
+        start = time.perf_counter()
+        analysed = 0
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(backend, quantize, threshold, threads),
+        ) as executor:
+            futures = {
+                executor.submit(reanalyse_record, *record): record[1] for record in records
+            }
+            for future in as_completed(futures):
+                try:
+                    record_id, record = future.result()
+                except Exception as e:
+                    logging.error(f"Error re-analysing {futures[future]}: {e}")
+                    continue
+
+                replace_results(
+                    conn,
+                    record_id,
+                    record["duration"],
+                    record["class_name"],
+                    annotation_rows(record_id, record["annotation"]),
+                )
+                analysed += 1
+                logging.info(f"Processed file {analysed} of {len(records)}")
+
+    elapsed = time.perf_counter() - start
+    if records and not analysed:
+        logging.error(f"All {len(records)} records failed to re-analyse")
+        sys.exit(1)
+    logging.info(
+        f"Re-analysis complete, {analysed} files in {elapsed:.0f}s ({analysed / max(elapsed, 1e-9):.2f} files/sec)"
+    )
@@ -1,6 +1,11 @@
+import hashlib
+import io
 import logging
+import struct
 from pathlib import Path
 
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+
 
 def find_file(file_name: str, directory: Path)  -> Path | None:
     """
@@ -18,6 +23,160 @@ def find_file(file_name: str, directory: Path)  -> Path | None:
         return file_path  # Return the first match
     return None  # File not found
 
+def find_wav_chunk(file_obj, chunk_id: bytes) -> tuple[int, int] | None:
+    """
+    Walks the RIFF chunks of an open WAV file and returns the offset and length of a chunk's contents.
+
+    Args:
+        file_obj: Binary file object.
+        chunk_id (bytes): Four byte chunk id, e.g. b"fmt " or b"data".
+
+    Returns:
+        tuple[int, int] | None: (offset, length) of the chunk contents, or None if the file is not a
+                                RIFF/WAVE file or has no such chunk.
+    """
+    file_obj.seek(0)
+    header = file_obj.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+
+    offset = 12
+    while True:
+        file_obj.seek(offset)
+        chunk_header = file_obj.read(8)
+        if len(chunk_header) < 8:
+            return None
+        current_id, chunk_size = struct.unpack("<4sI", chunk_header)
+        if current_id == chunk_id:
+            return offset + 8, chunk_size
+        # chunks are word aligned
+        offset += 8 + chunk_size + (chunk_size % 2)
+
+
+def find_wav_data_chunk(file_obj) -> tuple[int, int] | None:
+    """
+    Returns the offset and length of the PCM samples in an open WAV file, see `find_wav_chunk`.
+    """
+    return find_wav_chunk(file_obj, b"data")
+
+
+def read_wav_format(file_obj) -> tuple[int, int, int] | None:
+    """
+    Reads the `fmt ` chunk of an open WAV file.
+
+    Returns:
+        tuple[int, int, int] | None: (channels, sample rate, bits per sample), or None if the file is not a RIFF/WAVE file.
+    """
+    fmt_chunk = find_wav_chunk(file_obj, b"fmt ")
+    if fmt_chunk is None:
+        return None
+    file_obj.seek(fmt_chunk[0])
+    _, channels, sample_rate, _, _, bits = struct.unpack("<HHIIHH", file_obj.read(16))
+    return channels, sample_rate, bits
+
+
+class ArchivedFile(io.RawIOBase):
+    """
+    Read-only file object over a single member of a backup archive, given its byte offset and
+    length (`archive_offset` / `archive_length`). Seeking is relative to the member, so audio
+    libraries can use FLAC seek tables without the member being copied out of the archive.
+    """
+
+    def __init__(self, archive_path: Path, offset: int, length: int):
+        super().__init__()
+        self._file = open(archive_path, "rb")
+        self._start = offset
+        self._length = length
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._length
+        self._position = min(max(offset, 0), self._length)
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._length - self._position)
+        if size <= 0:
+            return 0
+        self._file.seek(self._start + self._position)
+        read = self._file.readinto(memoryview(buffer)[:size])
+        self._position += read
+        return read
+
+    def close(self) -> None:
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+
+def audio_fingerprint(file_path: Path) -> str:
+    """
+    Returns a content fingerprint of a WAV file's PCM data, so renamed or re-copied files can be
+    recognised regardless of their name, folder or metadata chunks. Files that are not RIFF/WAVE
+    are hashed in full.
+
+    Args:
+        file_path (Path): Path to the audio file.
+
+    Returns:
+        str: Hex digest of the audio data.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(file_path, "rb") as f:
+        data_chunk = find_wav_data_chunk(f)
+        if data_chunk is None:
+            offset, remaining = 0, None
+        else:
+            offset, remaining = data_chunk
+        f.seek(offset)
+
+        while remaining is None or remaining > 0:
+            size = FINGERPRINT_BLOCK_SIZE if remaining is None else min(FINGERPRINT_BLOCK_SIZE, remaining)
+            block = f.read(size)
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+
+    return digest.hexdigest()
+
+
+def decoded_fingerprint(file) -> str:
+    """
+    Returns the fingerprint of a FLAC file's decoded samples. For a FLAC converted from a 16 bit
+    WAV this equals `audio_fingerprint` of the WAV, so backups can be matched to their record.
+
+    Args:
+        file: Path or binary file object, e.g. an `ArchivedFile`.
+
+    Returns:
+        str: Hex digest of the samples as interleaved little endian 16 bit PCM.
+    """
+    import soundfile as sf
+
+    digest = hashlib.blake2b(digest_size=16)
+    with sf.SoundFile(file) as snd:
+        frames = FINGERPRINT_BLOCK_SIZE // (2 * snd.channels)
+        for block in snd.blocks(blocksize=frames, dtype="int16", always_2d=True):
+            digest.update(block.astype("<i2", copy=False).tobytes())
+
+    return digest.hexdigest()
+
+
 def setup_logging():
     logging.basicConfig(
         level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -0,0 +1,183 @@
+import itertools
+import math
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Iterator, Optional
+from bat_acoustic_tools.file_index import scan_root
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog is optional, fall back to polling
+    FileSystemEventHandler = object
+    Observer = None
+
+"""
+Watch a deployment tree for new WAV files as they are copied from SD cards.
+
+Uses filesystem notifications (inotify on linux) through watchdog when it is installed,
+otherwise the tree is polled. A file is only handed on once its size and modification
+time have been unchanged for `settle_time` seconds, so partially copied files are never
+passed to BatDetect2.
+"""
+
+
+class _WavEventHandler(FileSystemEventHandler):
+    """
+    Collects the paths of WAV files and directories that are created, modified or moved
+    into the tree, the watch loop only looks at these rather than rescanning everything.
+    """
+
+    def __init__(self, wake: threading.Event):
+        super().__init__()
+        self.wake = wake
+        self.lock = threading.Lock()
+        self.files = set()
+        self.directories = set()
+
+    def on_any_event(self, event):
+        if event.event_type not in ("created", "modified", "moved", "closed"):
+            return
+        path = getattr(event, "dest_path", "") or event.src_path
+        with self.lock:
+            if event.is_directory:
+                # a directory moved or copied in may arrive with its files already inside
+                if event.event_type != "modified":
+                    self.directories.add(Path(path))
+            elif path.lower().endswith(".wav"):
+                self.files.add(Path(path))
+            else:
+                return
+        self.wake.set()
+
+    def drain(self) -> Iterator[Path]:
+        with self.lock:
+            files, self.files = self.files, set()
+            directories, self.directories = self.directories, set()
+        yield from files
+        for directory in directories:
+            yield from scan_wav_files(directory)
+
+
+def scan_wav_files(directory: Path) -> Iterator[Path]:
+    """
+    Recursively yields WAV files under a directory, using the same walker as `reindex`.
+
+    Args:
+        directory (Path): Root directory to scan.
+
+    Returns:
+        Iterator[Path]: Paths of WAV files found in the tree.
+    """
+    for rel_path, *_ in scan_root(directory, (".wav",), workers=1):
+        yield directory / rel_path
+
+
+def _file_state(file_path: Path) -> Optional[tuple]:
+    try:
+        stat = file_path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def watch_directory(
+    directory: Path,
+    settle_time: float = 10.0,
+    poll_interval: float = 30.0,
+    idle_timeout: Optional[float] = None,
+) -> Iterator[Path]:
+    """
+    Yields WAV files under `directory` once they have finished copying.
+
+    Files already present when the watch starts are yielded too, each file is yielded once.
+
+    Args:
+        directory (Path): Root of the deployment tree to watch.
+        settle_time (float): Seconds a file's size and mtime must be unchanged before it is yielded.
+        poll_interval (float): Seconds between full rescans of the tree when watchdog is not
+                               installed, with watchdog the tree is only scanned once at the start
+                               and then follows the paths of filesystem events.
+        idle_timeout (float, optional): Stop watching after this many seconds without a new file,
+                                        defaults to None which watches until interrupted.
+
+    Returns:
+        Iterator[Path]: Paths of fully copied WAV files in order of arrival.
+    """
+    wake = threading.Event()
+    observer = None
+    handler = None
+
+    if Observer is not None:
+        handler = _WavEventHandler(wake)
+        observer = Observer()
+        observer.schedule(handler, str(directory), recursive=True)
+        observer.start()
+        logging.info(f"Watching {directory} for new WAV files")
+    else:
+        logging.info(
+            f"watchdog not installed, polling {directory} every {poll_interval}s for new WAV files"
+        )
+
+    seen = set()
+    # path -> (size, mtime, time of last change)
+    pending = {}
+    last_activity = time.monotonic()
+    next_scan = 0.0
+
+    try:
+        while True:
+            now = time.monotonic()
+
+            candidates = []
+            if wake.is_set():
+                wake.clear()
+                candidates.append(handler.drain())
+            if now >= next_scan:
+                # full scan at start, after that only when polling
+                next_scan = now + poll_interval if observer is None else math.inf
+                candidates.append(scan_wav_files(directory))
+
+            for file_path in itertools.chain.from_iterable(candidates):
+                if file_path in seen or file_path in pending:
+                    continue
+                state = _file_state(file_path)
+                if state is not None:
+                    pending[file_path] = (*state, now)
+                    last_activity = now
+
+            for file_path, (size, mtime, changed_at) in list(pending.items()):
+                state = _file_state(file_path)
+                if state is None:
+                    # removed or renamed before copying finished
+                    del pending[file_path]
+                elif state != (size, mtime):
+                    pending[file_path] = (*state, now)
+                    last_activity = now
+                elif now - changed_at >= settle_time:
+                    del pending[file_path]
+                    seen.add(file_path)
+                    yield file_path
+                    last_activity = time.monotonic()
+
+            now = time.monotonic()
+            if (
+                idle_timeout is not None
+                and not pending
+                and now - last_activity >= idle_timeout
+            ):
+                logging.info(f"No new files for {idle_timeout}s, stopping watch")
+                return
+
+            timeout = next_scan - now
+            if pending:
+                timeout = min(timeout, settle_time / 2)
+            if idle_timeout is not None:
+                timeout = min(timeout, idle_timeout)
+            wake.wait(max(timeout, 0.1) if timeout != math.inf else None)
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
@@ -1,5 +1,21 @@
+import os
+import sqlite3
+import tarfile
+import tempfile
 import unittest
-from bat_acoustic_tools.backup_wavs import create_flac_path
+import ffmpeg
+from bat_acoustic_tools import backup_wavs
+from bat_acoustic_tools.backup_wavs import (
+    append_to_archive,
+    create_archive_path,
+    create_flac_path,
+    get_recording_night,
+    open_archive,
+    read_archived_file,
+)
+from bat_acoustic_tools.db.utils import create_schema, insert_record, set_backup
+from bat_acoustic_tools.file_index import reindex
+from bat_acoustic_tools.utils import audio_fingerprint
 from unittest.mock import patch
 from pathlib import Path
 
@@ -45,5 +61,210 @@ class TestCreateFlacPath(unittest.TestCase):
             create_flac_path(wav_file, flac_root)
 
 
+class TestArchive(unittest.TestCase):
+    @patch("pathlib.Path.mkdir")
+    def test_create_archive_path(self, mock_mkdir):
+        wav_file = Path("/home/user/data/2023-11-01/location_123/data/file.wav")
+        flac_root = Path("/home/user/flac")
+
+        result = create_archive_path(wav_file, flac_root, "2023-10-31")
+
+        self.assertEqual(
+            result, Path("/home/user/flac/2023-11-01/location_123/data/2023-10-31.tar")
+        )
+
+    def test_append_and_read_archived_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            archive_path = tmp / "2024-04-15.tar"
+            contents = {"a.flac": b"fLaC" + b"a" * 1000, "b.flac": b"fLaC" + b"b" * 10}
+
+            offsets = {}
+            for name, data in contents.items():
+                flac_file = tmp / name
+                flac_file.write_bytes(data)
+                # reopen to check appending to an existing archive
+                with tarfile.open(archive_path, "a") as archive:
+                    offsets[name] = append_to_archive(archive, flac_file)
+
+            for name, (offset, length) in offsets.items():
+                self.assertEqual(
+                    read_archived_file(archive_path, offset, length), contents[name]
+                )
+
+            with tarfile.open(archive_path) as archive:
+                self.assertEqual(archive.getnames(), list(contents))
+
+    def test_get_recording_night_from_file_name(self):
+        with sqlite3.connect(":memory:") as conn:
+            conn.execute(
+                "create table record_data (id INTEGER PRIMARY KEY, recording_night DATE)"
+            )
+
+            self.assertEqual(
+                get_recording_night(conn, 1, "SMU01770-2_20240416_022448.wav"),
+                "2024-04-15",
+            )
+            self.assertEqual(
+                get_recording_night(conn, 1, "SMU01770-2_20240416_212448.wav"),
+                "2024-04-16",
+            )
+
+    def test_open_truncated_archive(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            archive_path = tmp / "2024-04-15.tar"
+            db_path = tmp / "test_db.sqlite3"
+            create_schema(db_path)
+            for name in ["a.flac", "b.flac"]:
+                (tmp / name).write_bytes(b"fLaC" + name.encode() * 1000)
+            with sqlite3.connect(db_path) as conn:
+                record_id = insert_record(
+                    conn,
+                    ("a.wav", "GC01", "SMU01770-2", None, 3.0, "None", "2024-04-15", "no", None,
+                     None, "no", None, str(tmp / "a.wav"), None),
+                )
+                with tarfile.open(archive_path, "a") as archive:
+                    offset, length = append_to_archive(archive, tmp / "a.flac")
+                    set_backup(conn, record_id, archive_path, offset, length)
+                    b_offset, _ = append_to_archive(archive, tmp / "b.flac")
+                # as left by a backup interrupted part way through appending b.flac
+                os.truncate(archive_path, b_offset + 1000)
+
+                with open_archive(conn, archive_path) as archive:
+                    self.assertEqual(archive.getnames(), ["a.flac"])
+                    append_to_archive(archive, tmp / "b.flac")
+
+            with tarfile.open(archive_path) as archive:
+                self.assertEqual(archive.getnames(), ["a.flac", "b.flac"])
+            self.assertEqual(read_archived_file(archive_path, offset, length), (tmp / "a.flac").read_bytes())
+
+    def test_open_archive_damaged_before_last_backup(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            archive_path = tmp / "2024-04-15.tar"
+            archive_path.write_bytes(b"x" * 2048)
+            db_path = tmp / "test_db.sqlite3"
+            create_schema(db_path)
+            with sqlite3.connect(db_path) as conn:
+                record_id = insert_record(
+                    conn,
+                    ("a.wav", "GC01", "SMU01770-2", None, 3.0, "None", "2024-04-15", "no", None,
+                     None, "no", None, str(tmp / "a.wav"), None),
+                )
+                set_backup(conn, record_id, archive_path, 512, 100)
+
+                self.assertIsNone(open_archive(conn, archive_path))
+            # committed backups are never cut off
+            self.assertEqual(archive_path.stat().st_size, 2048)
+
+
+class TestArchiveBackup(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmp.name)
+        self.flac_root = tmp / "flac"
+        self.flac_root.mkdir()
+        self.wav_file = tmp / "2024-04-16" / "GC01" / "Data" / "SMU01770-2_20240416_022448.wav"
+        self.wav_file.parent.mkdir(parents=True)
+        self.wav_file.write_bytes(b"RIFF")
+
+        self.db_path = tmp / "test_db.sqlite3"
+        create_schema(self.db_path)
+        with sqlite3.connect(self.db_path) as conn:
+            insert_record(
+                conn,
+                (self.wav_file.name, "GC01", "SMU01770-2", "2024-04-16 02:24:48+01:00", 3.0, "None",
+                 "2024-04-15", "no", None, None, "no", None, str(self.wav_file), audio_fingerprint(self.wav_file)),
+            )
+        self.archive_path = self.flac_root / "2024-04-16" / "GC01" / "data" / "2024-04-15.tar"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _backup(self):
+        backup_wavs.main(
+            self.wav_file.parent,
+            self.flac_root,
+            self.db_path,
+            "select file_name, record_path from records",
+            archive=True,
+        )
+
+    def _stored_backup(self):
+        with sqlite3.connect(self.db_path) as conn:
+            return conn.execute(
+                "select backup, backup_path, archive_offset, archive_length from records"
+            ).fetchone()
+
+    def test_backup_stored_before_wav_deleted(self):
+        def convert(wav_file_path, flac_path):
+            flac_path.write_bytes(b"fLaC" + b"a" * 100)
+
+        stored_at_delete = []
+        unlink = Path.unlink
+
+        def check_unlink(path, *args, **kwargs):
+            if path == self.wav_file:
+                stored_at_delete.append(self._stored_backup())
+            unlink(path, *args, **kwargs)
+
+        with patch.object(backup_wavs, "convert_to_flac", convert), patch.object(Path, "unlink", check_unlink):
+            self._backup()
+
+        self.assertFalse(self.wav_file.exists())
+        self.assertEqual(stored_at_delete, [self._stored_backup()])
+        backup, backup_path, offset, length = stored_at_delete[0]
+        self.assertEqual((backup, backup_path), ("yes", str(self.archive_path)))
+        self.assertEqual(read_archived_file(self.archive_path, offset, length), b"fLaC" + b"a" * 100)
+        self.assertEqual(list(self.archive_path.parent.glob("*.flac")), [])
+
+    def test_failed_conversion_removes_partial_flac(self):
+        def convert(wav_file_path, flac_path):
+            flac_path.write_bytes(b"fLaC")
+            raise ffmpeg._run.Error("ffmpeg", b"", b"")
+
+        with patch.object(backup_wavs, "convert_to_flac", convert):
+            self._backup()
+
+        self.assertTrue(self.wav_file.exists())
+        self.assertEqual(self._stored_backup(), ("no", None, None, None))
+        self.assertEqual(list(self.archive_path.parent.glob("*.flac")), [])
+
+    def test_truncated_archive_recovered(self):
+        def convert(wav_file_path, flac_path):
+            flac_path.write_bytes(b"fLaC" + b"a" * 100)
+
+        # left by a backup interrupted before any file in the archive was committed
+        self.archive_path.parent.mkdir(parents=True)
+        self.archive_path.write_bytes(b"x" * 1000)
+
+        with patch.object(backup_wavs, "convert_to_flac", convert):
+            self._backup()
+
+        self.assertFalse(self.wav_file.exists())
+        backup, backup_path, offset, length = self._stored_backup()
+        self.assertEqual((backup, backup_path), ("yes", str(self.archive_path)))
+        with tarfile.open(self.archive_path) as archive:
+            self.assertEqual(archive.getnames(), [self.wav_file.stem + ".flac"])
+        self.assertEqual(read_archived_file(self.archive_path, offset, length), b"fLaC" + b"a" * 100)
+
+    def test_moved_file_from_other_detector_not_used(self):
+        # the record's WAV has gone, another detector's file with the same name is indexed
+        other_root = Path(self.tmp.name) / "other"
+        other_file = other_root / "2024-04-16" / "GC02" / "Data" / self.wav_file.name
+        other_file.parent.mkdir(parents=True)
+        other_file.write_bytes(b"RIFF from another detector")
+        self.wav_file.unlink()
+        reindex(self.db_path, [other_root], workers=1)
+
+        with patch.object(backup_wavs, "convert_to_flac") as convert:
+            self._backup()
+
+        convert.assert_not_called()
+        self.assertTrue(other_file.exists())
+        self.assertEqual(self._stored_backup(), ("no", None, None, None))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,82 @@
+import math
+import sqlite3
+import struct
+import tarfile
+import wave
+from pathlib import Path
+import pytest
+
+np = pytest.importorskip("numpy")
+sf = pytest.importorskip("soundfile")
+pytest.importorskip("matplotlib")
+
+from bat_acoustic_tools.db.utils import create_schema, insert_annotations, insert_record
+from bat_acoustic_tools.extract import main, read_segments
+from bat_acoustic_tools.file_index import find_source
+
+SAMPLE_RATE = 384000
+
+
+def _write_wav(path: Path, seconds: float = 1.0):
+    # deterministic sine so each segment read can be compared sample for sample
+    n = int(seconds * SAMPLE_RATE)
+    samples = [int(10000 * math.sin(i / 10)) for i in range(n)]
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        w.writeframes(struct.pack(f"<{n}h", *samples))
+    return np.array(samples, dtype=np.int16)
+
+
+def test_wav_flac_and_archive_sources_match(tmp_path):
+    samples = _write_wav(tmp_path / "rec.wav")
+    sf.write(tmp_path / "rec.flac", samples, SAMPLE_RATE, subtype="PCM_16")
+    with tarfile.open(tmp_path / "night.tar", "w") as archive:
+        archive.add(tmp_path / "rec.flac", arcname="rec.flac")
+    with tarfile.open(tmp_path / "night.tar") as archive:
+        member = archive.getmember("rec.flac")
+
+    segments = [(0.1, 0.15), (0.5, 0.52)]
+    sources = [
+        ("wav", str(tmp_path / "rec.wav")),
+        ("flac", str(tmp_path / "rec.flac")),
+        ("archive", str(tmp_path / "night.tar"), member.offset_data, member.size),
+    ]
+
+    for source in sources:
+        sample_rate, clips = read_segments(source, segments)
+        assert sample_rate == SAMPLE_RATE
+        for (start, end), clip in zip(segments, clips):
+            expected = samples[int(start * SAMPLE_RATE) : int(end * SAMPLE_RATE)]
+            np.testing.assert_array_equal(clip, expected)
+
+
+def test_extract(tmp_path):
+    _write_wav(tmp_path / "SMU01770-2_20240416_022448.wav")
+    db_path = tmp_path / "test_db.sqlite3"
+
+    create_schema(db_path)
+    with sqlite3.connect(db_path) as conn:
+        record_id = insert_record(
+            conn,
+            (
+                "SMU01770-2_20240416_022448.wav", "GC01", "SMU01770-2", None, 1.0,
+                "Pipistrellus pipistrellus", "2024-04-15", "no", None, None, "no", None,
+                str(tmp_path / "SMU01770-2_20240416_022448.wav"), None,
+            ),
+        )
+        insert_annotations(
+            conn,
+            [
+                (record_id, 0.1, 0.105, 40000, 60000, "Pipistrellus pipistrellus", 0.9, 0.8, -1, "Echolocation"),
+                (record_id, 0.6, 0.605, 40000, 60000, "Pipistrellus pipistrellus", 0.9, 0.8, -1, "Echolocation"),
+            ],
+        )
+        assert find_source(conn, record_id, "SMU01770-2_20240416_022448.wav", None, None, None, None, None) is None
+
+    output_dir = tmp_path / "clips"
+    main(db_path, output_dir, "select id from annotations", workers=1)
+
+    assert len(list(output_dir.glob("*.wav"))) == 2
+    assert len(list(output_dir.glob("*.png"))) == 2
@@ -0,0 +1,136 @@
+import shutil
+import sqlite3
+from pathlib import Path
+import pytest
+from bat_acoustic_tools.db.utils import create_schema, insert_record
+from bat_acoustic_tools.file_index import (
+    find_source,
+    reindex,
+    remap_root,
+    resolve_file,
+    scan_root,
+)
+from bat_acoustic_tools.utils import audio_fingerprint
+
+
+@pytest.fixture
+def storage(tmp_path):
+    root = tmp_path / "drive_d" / "Deployments"
+    for location in ("GC01", "GC02"):
+        data_dir = root / "2024-05-28" / location / "Data"
+        data_dir.mkdir(parents=True)
+        (data_dir / f"SMU01770-2_{location}.wav").write_bytes(b"RIFF")
+        # same file name from a different detector at each location
+        (data_dir / "SMU01770-2_20240529_010000.wav").write_bytes(location.encode())
+        (data_dir / "notes.txt").write_text("not audio")
+
+    db_path = tmp_path / "test_db.sqlite3"
+    create_schema(db_path)
+
+    return root, db_path
+
+
+def _record(conn, file_name, record_path, content_hash):
+    return insert_record(
+        conn,
+        (file_name, "GC01", "SMU01770-2", None, 1.0, "None", "2024-05-28", "no", None, None,
+         "no", None, str(record_path), content_hash),
+    )
+
+
+def test_scan_root(storage):
+    root, _ = storage
+
+    found = sorted(rel_path for rel_path, _, _, _ in scan_root(root, workers=2))
+
+    assert found == [
+        "2024-05-28/GC01/Data/SMU01770-2_20240529_010000.wav",
+        "2024-05-28/GC01/Data/SMU01770-2_GC01.wav",
+        "2024-05-28/GC02/Data/SMU01770-2_20240529_010000.wav",
+        "2024-05-28/GC02/Data/SMU01770-2_GC02.wav",
+    ]
+
+
+def test_reindex_and_resolve(storage):
+    root, db_path = storage
+    wav_file = root / "2024-05-28" / "GC01" / "Data" / "SMU01770-2_GC01.wav"
+
+    reindex(db_path, [root], workers=2)
+    # reindexing replaces rather than duplicates entries
+    reindex(db_path, [root], workers=2)
+
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT count(*) FROM file_index").fetchone()[0] == 4
+        assert resolve_file(conn, "SMU01770-2_GC01.wav", audio_fingerprint(wav_file)) == wav_file
+        assert resolve_file(conn, "missing.wav", "abc") is None
+        # records without a content hash cannot be checked
+        assert resolve_file(conn, "SMU01770-2_GC01.wav", None) is None
+
+
+def test_resolve_checks_audio(storage):
+    root, db_path = storage
+    reindex(db_path, [root], workers=2)
+    name = "SMU01770-2_20240529_010000.wav"
+    gc02_file = root / "2024-05-28" / "GC02" / "Data" / name
+
+    with sqlite3.connect(db_path) as conn:
+        assert resolve_file(conn, name, audio_fingerprint(gc02_file)) == gc02_file
+        assert resolve_file(conn, name, "not the same audio") is None
+
+
+def test_find_source_updates_stale_path(storage, tmp_path):
+    root, db_path = storage
+    reindex(db_path, [root], workers=2)
+    wav_file = root / "2024-05-28" / "GC02" / "Data" / "SMU01770-2_GC02.wav"
+
+    with sqlite3.connect(db_path) as conn:
+        record_id = _record(conn, wav_file.name, tmp_path / "sd_card" / wav_file.name, audio_fingerprint(wav_file))
+
+        source = find_source(conn, record_id, wav_file.name, str(tmp_path / "sd_card" / wav_file.name), None, None, None, audio_fingerprint(wav_file))
+
+        assert source == ("wav", str(wav_file))
+        assert conn.execute("SELECT record_path FROM records").fetchone()[0] == str(wav_file)
+        assert conn.execute("SELECT record_path FROM record_data").fetchone()[0] == "2024-05-28/GC02/Data/SMU01770-2_GC02.wav"
+
+
+def test_remap_root(storage, tmp_path):
+    root, db_path = storage
+    wav_file = root / "2024-05-28" / "GC02" / "Data" / "SMU01770-2_GC02.wav"
+    content_hash = audio_fingerprint(wav_file)
+    with sqlite3.connect(db_path) as conn:
+        # recorded before the root was indexed, stored as an absolute path until then
+        _record(conn, wav_file.name, wav_file, content_hash)
+    reindex(db_path, [root], workers=2)
+
+    new_root = tmp_path / "drive_e" / "Deployments"
+    shutil.move(str(root.parent), str(new_root.parent))
+    new_wav_file = new_root / "2024-05-28" / "GC02" / "Data" / "SMU01770-2_GC02.wav"
+
+    with sqlite3.connect(db_path) as conn:
+        assert resolve_file(conn, wav_file.name, content_hash) is None
+        assert remap_root(conn, root, new_root) == 1
+        assert resolve_file(conn, wav_file.name, content_hash) == new_wav_file
+        # record paths under the root move with it
+        assert conn.execute("SELECT record_path FROM records").fetchone()[0] == str(new_wav_file)
+
+
+def test_remap_root_onto_indexed_root(storage, tmp_path):
+    root, db_path = storage
+    wav_file = root / "2024-05-28" / "GC02" / "Data" / "SMU01770-2_GC02.wav"
+    content_hash = audio_fingerprint(wav_file)
+    reindex(db_path, [root], workers=2)
+    with sqlite3.connect(db_path) as conn:
+        _record(conn, wav_file.name, wav_file, content_hash)
+
+    new_root = tmp_path / "drive_e" / "Deployments"
+    shutil.move(str(root.parent), str(new_root.parent))
+    new_wav_file = new_root / "2024-05-28" / "GC02" / "Data" / "SMU01770-2_GC02.wav"
+    # the drive was reindexed at its new location before being remapped
+    reindex(db_path, [new_root], workers=2)
+
+    with sqlite3.connect(db_path) as conn:
+        assert remap_root(conn, root, new_root) == 1
+        assert conn.execute("SELECT path FROM storage_roots").fetchall() == [(str(new_root),)]
+        assert conn.execute("SELECT record_path FROM records").fetchone()[0] == str(new_wav_file)
+        assert resolve_file(conn, wav_file.name, content_hash) == new_wav_file
+        assert conn.execute("SELECT count(*) FROM file_index").fetchone()[0] == 4
@@ -0,0 +1,64 @@
+from pathlib import Path
+import pytest
+
+pytest.importorskip("batdetect2")
+
+from bat_acoustic_tools.inference import Backend, load_backend
+from bat_acoustic_tools.process_wavs import get_config
+
+DATA_DIR = Path(__file__).parent.parent / "data"
+AUDIO_FILES = sorted(str(f) for f in DATA_DIR.glob("*.wav"))
+
+
+@pytest.fixture(scope="module")
+def reference():
+    conf = get_config(0.5)
+    backend = load_backend(Backend.pytorch)
+    return conf, {f: backend.process_file(f, conf)["pred_dict"] for f in AUDIO_FILES}
+
+
+def _starts(pred_dict):
+    return sorted(round(a["start_time"], 3) for a in pred_dict["annotation"])
+
+
+@pytest.mark.parametrize("backend", [Backend.torchscript, Backend.onnx])
+def test_exported_backend_parity(reference, backend, tmp_path):
+    if backend is Backend.onnx:
+        pytest.importorskip("onnxruntime")
+    conf, expected = reference
+    exported = load_backend(backend, cache_dir=tmp_path)
+
+    for f in AUDIO_FILES:
+        pred_dict = exported.process_file(f, conf)["pred_dict"]
+        assert pred_dict["class_name"] == expected[f]["class_name"]
+        assert _starts(pred_dict) == _starts(expected[f])
+        for a, b in zip(
+            sorted(pred_dict["annotation"], key=lambda a: a["start_time"]),
+            sorted(expected[f]["annotation"], key=lambda a: a["start_time"]),
+        ):
+            assert a["class"] == b["class"]
+            assert a["det_prob"] == pytest.approx(b["det_prob"], abs=1e-3)
+
+
+def test_quantised_onnx_agreement(reference, tmp_path):
+    pytest.importorskip("onnxruntime")
+    conf, expected = reference
+    quantised = load_backend(Backend.onnx, quantize=True, cache_dir=tmp_path)
+    # intermediate exports are removed, only the quantised model is cached
+    assert [p.name.endswith("-onnx-int8.onnx") for p in tmp_path.iterdir()] == [True]
+
+    agree = sum(
+        quantised.process_file(f, conf)["pred_dict"]["class_name"]
+        == expected[f]["class_name"]
+        for f in AUDIO_FILES
+    )
+
+    # int8 weights shift probabilities slightly, file level classes should still agree
+    assert agree / len(AUDIO_FILES) >= 0.9
+
+
+@pytest.mark.parametrize("backend", [Backend.pytorch, Backend.torchscript])
+def test_quantize_only_supported_by_onnx(backend):
+    # BatDetect2's attention layers read `.weight` directly, which breaks after torch quantisation
+    with pytest.raises(ValueError):
+        load_backend(backend, quantize=True)
@@ -0,0 +1,190 @@
+import sqlite3
+from pathlib import Path
+import pytest
+from bat_acoustic_tools.db.migrate import (
+    BENCHMARK_QUERIES,
+    FLAT_BENCHMARK_QUERIES,
+    migrate,
+    needs_migration,
+    schema_version,
+)
+from bat_acoustic_tools.db.utils import LOOKUPS, SCHEMA_VERSION
+
+LEGACY_RECORDS = """
+CREATE TABLE records (
+    id INTEGER PRIMARY KEY,
+    file_name TEXT UNIQUE,
+    location_id TEXT,
+    serial TEXT,
+    record_time TIMESTAMP,
+    duration FLOAT,
+    class_name TEXT,
+    recording_night DATE,
+    validated TEXT DEFAULT 'no',
+    id_correct TEXT,
+    comments TEXT,
+    backup TEXT,
+    backup_path TEXT,
+    record_path TEXT
+);
+"""
+
+LEGACY_ANNOTATIONS = """
+CREATE TABLE annotations (
+    id INTEGER PRIMARY KEY,
+    record_id INTEGER,
+    start_time FLOAT,
+    end_time FLOAT,
+    low_freq INTEGER,
+    high_freq INTEGER,
+    spp_class TEXT,
+    class_prob FLOAT,
+    det_prob FLOAT,
+    individual INTEGER,
+    event TEXT,
+    FOREIGN KEY (record_id) REFERENCES records(id) ON DELETE CASCADE
+);
+"""
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    db_path = tmp_path / "legacy.sqlite3"
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(LEGACY_RECORDS)
+        conn.execute(LEGACY_ANNOTATIONS)
+        for i in range(1, 26):
+            conn.execute(
+                "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'no', NULL, NULL, 'no', NULL, ?)",
+                (
+                    i,
+                    f"SMU01770-2_20240416_{i:06d}.wav",
+                    f"GC0{i % 3}",
+                    "SMU01770-2",
+                    "2024-04-16 02:24:48+01:00",
+                    3.0,
+                    "None" if i % 2 else "Pipistrellus pipistrellus",
+                    "2024-04-15",
+                    f"/data/SMU01770-2_20240416_{i:06d}.wav",
+                ),
+            )
+            conn.execute(
+                "INSERT INTO annotations(record_id, start_time, end_time, low_freq, high_freq, spp_class, class_prob, det_prob, individual, event) VALUES (?, 0.1, 0.2, 40000, 60000, 'Pipistrellus pipistrellus', 0.9, 0.8, -1, 'Echolocation')",
+                (i,),
+            )
+        conn.commit()
+        expected_records = conn.execute("SELECT * FROM records ORDER BY id").fetchall()
+        expected_annotations = conn.execute(
+            "SELECT * FROM annotations ORDER BY id"
+        ).fetchall()
+
+    return db_path, expected_records, expected_annotations
+
+
+RECORD_COLUMNS = "id, file_name, location_id, serial, record_time, duration, class_name, recording_night, validated, id_correct, comments, backup, backup_path, record_path"
+
+
+def test_migrate_preserves_views(legacy_db):
+    db_path, expected_records, expected_annotations = legacy_db
+
+    migrate(Path(db_path), batch_size=7)
+
+    with sqlite3.connect(db_path) as conn:
+        assert not needs_migration(conn)
+        assert schema_version(conn) == SCHEMA_VERSION
+        assert conn.execute(f"SELECT {RECORD_COLUMNS} FROM records ORDER BY id").fetchall() == expected_records
+        assert (
+            conn.execute("SELECT * FROM annotations ORDER BY id").fetchall()
+            == expected_annotations
+        )
+        assert conn.execute("SELECT count(*) FROM locations").fetchone()[0] == 3
+        assert conn.execute("SELECT count(*) FROM species").fetchone()[0] == 2
+
+
+def test_base_table_queries_match_flat(legacy_db):
+    db_path, _, _ = legacy_db
+
+    with sqlite3.connect(db_path) as conn:
+        expected = [sorted(conn.execute(q).fetchall()) for q in FLAT_BENCHMARK_QUERIES]
+
+    migrate(Path(db_path), vacuum=False)
+
+    with sqlite3.connect(db_path) as conn:
+        assert [sorted(conn.execute(q).fetchall()) for q in BENCHMARK_QUERIES] == expected
+
+
+def test_migrate_resumes(legacy_db):
+    db_path, expected_records, _ = legacy_db
+
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("ALTER TABLE records RENAME TO legacy_records")
+        conn.execute("ALTER TABLE annotations RENAME TO legacy_annotations")
+        conn.commit()
+
+    migrate(Path(db_path), batch_size=10, vacuum=False)
+
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute(f"SELECT {RECORD_COLUMNS} FROM records ORDER BY id").fetchall() == expected_records
+
+
+def test_upgrade_adds_content_hash(tmp_path):
+    db_path = tmp_path / "v1.sqlite3"
+
+    with sqlite3.connect(db_path) as conn:
+        for statement in LOOKUPS:
+            conn.execute(statement)
+        conn.execute(
+            "CREATE TABLE record_data (id INTEGER PRIMARY KEY, file_name TEXT UNIQUE, location_ref INTEGER, detector_ref INTEGER, record_time TIMESTAMP, duration FLOAT, class_ref INTEGER, recording_night DATE, validated TEXT DEFAULT 'no', id_correct TEXT, comments TEXT, backup TEXT, backup_path TEXT, record_path TEXT)"
+        )
+        conn.execute("CREATE VIEW records AS SELECT * FROM record_data")
+        conn.execute("INSERT INTO record_data(file_name) VALUES ('a.wav')")
+        conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+        assert needs_migration(conn)
+
+    migrate(Path(db_path), vacuum=False)
+
+    with sqlite3.connect(db_path) as conn:
+        assert schema_version(conn) == SCHEMA_VERSION
+        assert conn.execute("SELECT file_name, content_hash FROM records").fetchall() == [
+            ("a.wav", None)
+        ]
+        # file names no longer have to be unique
+        conn.execute("INSERT INTO record_data(file_name, content_hash) VALUES ('a.wav', 'abc')")
+
+
+def test_upgrade_stores_paths_relative_to_roots(tmp_path):
+    db_path = tmp_path / "v1.sqlite3"
+    root = tmp_path / "Deployments"
+    record_path = str(root / "2024-05-28" / "GC01" / "Data" / "a.wav")
+    other_path = str(tmp_path / "elsewhere" / "b.wav")
+
+    with sqlite3.connect(db_path) as conn:
+        for statement in LOOKUPS:
+            conn.execute(statement)
+        conn.execute(
+            "CREATE TABLE record_data (id INTEGER PRIMARY KEY, file_name TEXT UNIQUE, location_ref INTEGER, detector_ref INTEGER, record_time TIMESTAMP, duration FLOAT, class_ref INTEGER, recording_night DATE, validated TEXT DEFAULT 'no', id_correct TEXT, comments TEXT, backup TEXT, backup_path TEXT, record_path TEXT)"
+        )
+        conn.execute("CREATE VIEW records AS SELECT * FROM record_data")
+        conn.execute("CREATE TABLE storage_roots (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL)")
+        conn.execute("INSERT INTO storage_roots(path) VALUES (?)", (str(root),))
+        conn.execute("INSERT INTO record_data(file_name, record_path) VALUES ('a.wav', ?)", (record_path,))
+        conn.execute("INSERT INTO record_data(file_name, record_path) VALUES ('b.wav', ?)", (other_path,))
+        conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+
+    migrate(Path(db_path), vacuum=False)
+
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute("SELECT record_path, record_root_ref FROM record_data ORDER BY id").fetchall() == [
+            ("2024-05-28/GC01/Data/a.wav", 1),
+            (other_path, None),
+        ]
+        assert conn.execute("SELECT record_path FROM records ORDER BY id").fetchall() == [
+            (record_path,),
+            (other_path,),
+        ]
+        # a path set through the view is stored as given
+        conn.execute("UPDATE records SET record_path = ? WHERE id = 1", (other_path,))
+        assert conn.execute("SELECT record_path, record_root_ref FROM record_data WHERE id = 1").fetchone() == (other_path, None)
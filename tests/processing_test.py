@@ -1,13 +1,14 @@
 import sqlite3
 from pathlib import Path
 import pytest
-from src.bat_acoustic_tools.process_wavs import (
-    executemany_query,
-    execute_query,
-    INSERT_ANNOTATION,
-    INSERT_RECORD,
+from src.bat_acoustic_tools.db.utils import (
+    SCHEMA,
+    insert_record,
+    insert_annotations,
+    find_record_by_hash,
+    find_records_by_name,
+    replace_results,
 )
-from src.bat_acoustic_tools.db.utils import RECORDS, ANNOTATIONS
 
 
 @pytest.fixture
@@ -16,8 +17,8 @@ def temp_db(tmpdir):
 
     conn = sqlite3.connect(str(db_path))
     cursor = conn.cursor()
-    cursor.execute(RECORDS)
-    cursor.execute(ANNOTATIONS)
+    for statement in SCHEMA:
+        cursor.execute(statement)
     conn.commit()
 
     yield conn
@@ -43,14 +44,15 @@ def test_insert_record(temp_db):
         "no",
         None,
         r"D:\Goblin Combe - Bat Data\2024\Deployments\2024-08-06\BW31\Data\SMU12567_20240825_020025.wav",
+        "6acd81c325b36ced507a84d5a59ec205",
     )
 
-    record_id = execute_query(temp_db, INSERT_RECORD, record_values)
+    record_id = insert_record(temp_db, record_values)
 
     cur.execute("SELECT * FROM records WHERE id=?", (1,))
     record = cur.fetchone()
     assert record_id is not None
-    assert record[1::] == record_values
+    assert record[1:15] == record_values
 
 
 def test_insert_annotations(temp_db):
@@ -70,16 +72,17 @@ def test_insert_annotations(temp_db):
         "no",
         None,
         r"D:\Goblin Combe - Bat Data\2024\Deployments\2024-08-06\BW31\Data\SMU12567_20240825_020025.wav",
+        "6acd81c325b36ced507a84d5a59ec205",
     )
 
-    record_id = execute_query(temp_db, INSERT_RECORD, record_values)
+    record_id = insert_record(temp_db, record_values)
 
     annotations = [
         (record_id, 0.0, 1.0, 16000, 20000, "species", 0.9, 0.8, 1, "event1"),
         (record_id, 1.5, 2.5, 16000, 20000, "species", 0.9, 0.8, 1, "event2"),
     ]
 
-    executemany_query(temp_db, INSERT_ANNOTATION, annotations)
+    insert_annotations(temp_db, annotations)
 
     cur.execute(
         "SELECT record_id, start_time, end_time, low_freq, high_freq, spp_class, class_prob, det_prob, individual, event FROM annotations WHERE record_id=?",
@@ -89,3 +92,157 @@ def test_insert_annotations(temp_db):
     rows = cur.fetchall()
     assert len(rows) == 2
     assert rows == annotations
+
+    cur.execute("SELECT count(*) FROM species")
+    assert cur.fetchone()[0] == 2
+
+
+def test_update_records_view(temp_db):
+    cur = temp_db.cursor()
+
+    record_values = (
+        "test_file.wav",
+        "GC01",
+        "test_serial",
+        "2024-08-25 02:00:25+01:00",
+        3.1,
+        "None",
+        "2024-08-24",
+        "no",
+        None,
+        None,
+        "no",
+        None,
+        None,
+        None,
+    )
+
+    record_id = insert_record(temp_db, record_values)
+
+    cur.execute(
+        "UPDATE records SET validated = 'yes', class_name = 'Myotis' WHERE file_name = ?",
+        ("test_file.wav",),
+    )
+
+    cur.execute("SELECT validated, class_name FROM records WHERE id=?", (record_id,))
+    assert cur.fetchone() == ("yes", "Myotis")
+
+
+def test_find_records(temp_db):
+    record_values = (
+        "test_file.wav",
+        "GC01",
+        "test_serial",
+        "2024-08-25 02:00:25+01:00",
+        3.1,
+        "None",
+        "2024-08-24",
+        "no",
+        None,
+        None,
+        "no",
+        None,
+        None,
+        "6acd81c325b36ced507a84d5a59ec205",
+    )
+
+    record_id = insert_record(temp_db, record_values)
+    # same name from a different detector
+    other_id = insert_record(temp_db, (*record_values[:-1], "f633397ccb264869d96b7960b0ca8470"))
+
+    assert find_record_by_hash(temp_db, "6acd81c325b36ced507a84d5a59ec205") == "test_file.wav"
+    assert find_record_by_hash(temp_db, "34d0864a5851add5d59a4d3d5a9e67f4") is None
+    assert find_records_by_name(temp_db, "test_file.wav") == [
+        (record_id, "6acd81c325b36ced507a84d5a59ec205"),
+        (other_id, "f633397ccb264869d96b7960b0ca8470"),
+    ]
+
+
+def test_replace_results(temp_db):
+    cur = temp_db.cursor()
+
+    record_values = (
+        "test_file.wav",
+        "GC01",
+        "test_serial",
+        "2024-08-25 02:00:25+01:00",
+        3.1,
+        "None",
+        "2024-08-24",
+        "no",
+        None,
+        None,
+        "yes",
+        r"H:\Goblin Combe - Bat Data\2024\BW31\data\2024-08-24.tar",
+        None,
+        "6acd81c325b36ced507a84d5a59ec205",
+    )
+
+    record_id = insert_record(temp_db, record_values)
+    insert_annotations(
+        temp_db,
+        [(record_id, 0.0, 1.0, 16000, 20000, "species", 0.9, 0.8, 1, "event1")],
+    )
+
+    annotations = [
+        (record_id, 0.5, 0.6, 40000, 50000, "Pipistrellus pipistrellus", 0.7, 0.6, 0, "Echolocation"),
+    ]
+    replace_results(temp_db, record_id, 3.0, "Pipistrellus pipistrellus", annotations)
+
+    cur.execute(
+        "SELECT duration, class_name, backup, backup_path, content_hash FROM records WHERE id = ?",
+        (record_id,),
+    )
+    assert cur.fetchone() == (3.0, "Pipistrellus pipistrellus", "yes", record_values[11], record_values[13])
+
+    cur.execute(
+        "SELECT record_id, start_time, end_time, low_freq, high_freq, spp_class, class_prob, det_prob, individual, event FROM annotations WHERE record_id=?",
+        (record_id,),
+    )
+    assert cur.fetchall() == annotations
+
+
+def test_replace_results_resets_validation(temp_db):
+    cur = temp_db.cursor()
+
+    record_values = (
+        "test_file.wav",
+        "GC01",
+        "test_serial",
+        "2024-08-25 02:00:25+01:00",
+        3.1,
+        "Pipistrellus pipistrellus",
+        "2024-08-24",
+        "yes",
+        "yes",
+        None,
+        "yes",
+        None,
+        None,
+        "6acd81c325b36ced507a84d5a59ec205",
+    )
+    record_id = insert_record(temp_db, record_values)
+
+    # same class, validation still applies
+    replace_results(temp_db, record_id, 3.0, "Pipistrellus pipistrellus", [])
+    cur.execute("SELECT validated, id_correct FROM records WHERE id = ?", (record_id,))
+    assert cur.fetchone() == ("yes", "yes")
+
+    replace_results(temp_db, record_id, 3.0, "Myotis nattereri", [])
+    cur.execute("SELECT class_name, validated, id_correct FROM records WHERE id = ?", (record_id,))
+    assert cur.fetchone() == ("Myotis nattereri", "no", None)
+
+
+def test_analyse_file_reports_skipped_duplicates(temp_db, tmp_path):
+    pytest.importorskip("batdetect2")
+    from src.bat_acoustic_tools.process_wavs import analyse_file, get_config
+
+    wav_file = sorted((Path(__file__).parent.parent / "data").glob("*.wav"))[0]
+    copy = tmp_path / wav_file.name
+    copy.write_bytes(wav_file.read_bytes())
+    conf = get_config(0.5)
+
+    assert analyse_file(temp_db, wav_file, "GC01", conf) is True
+    # same audio at another path is not analysed again
+    assert analyse_file(temp_db, copy, "GC01", conf) is False
+    assert temp_db.execute("select count(*) from records").fetchone()[0] == 1
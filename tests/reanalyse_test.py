@@ -0,0 +1,89 @@
+import sqlite3
+import tarfile
+from pathlib import Path
+import pytest
+
+np = pytest.importorskip("numpy")
+sf = pytest.importorskip("soundfile")
+pytest.importorskip("batdetect2")
+
+from bat_acoustic_tools import reanalyse
+from bat_acoustic_tools.db.utils import create_schema, insert_record
+from bat_acoustic_tools.inference import Backend, load_backend
+from bat_acoustic_tools.process_wavs import get_config
+from bat_acoustic_tools.reanalyse import decode_audio
+
+SAMPLE_RATE = 384000
+DATA_DIR = Path(__file__).parent.parent / "data"
+AUDIO_FILES = sorted(DATA_DIR.glob("*.wav"))
+
+
+def test_decode_audio_sources_match(tmp_path):
+    samples = (10000 * np.sin(np.arange(SAMPLE_RATE) / 10)).astype(np.int16)
+    sf.write(tmp_path / "rec.wav", samples, SAMPLE_RATE, subtype="PCM_16")
+    sf.write(tmp_path / "rec.flac", samples, SAMPLE_RATE, subtype="PCM_16")
+    with tarfile.open(tmp_path / "night.tar", "w") as archive:
+        archive.add(tmp_path / "rec.flac", arcname="rec.flac")
+    with tarfile.open(tmp_path / "night.tar") as archive:
+        member = archive.getmember("rec.flac")
+
+    sources = [
+        ("wav", str(tmp_path / "rec.wav")),
+        ("flac", str(tmp_path / "rec.flac")),
+        ("archive", str(tmp_path / "night.tar"), member.offset_data, member.size),
+    ]
+
+    for source in sources:
+        audio, sample_rate = decode_audio(source)
+        assert sample_rate == SAMPLE_RATE
+        assert audio.dtype == np.float32
+        np.testing.assert_array_equal(audio, samples / np.float32(32768))
+
+
+@pytest.fixture(scope="module")
+def backend():
+    return load_backend(Backend.pytorch)
+
+
+@pytest.mark.parametrize("audio_file", AUDIO_FILES, ids=lambda f: f.name)
+@pytest.mark.parametrize("kind", ["wav", "flac"])
+def test_process_audio_matches_process_file(backend, audio_file, kind, tmp_path):
+    # process_audio follows batdetect2's process_file internals, this fails if an upgrade changes them
+    conf = get_config(0.5)
+    expected = backend.process_file(str(audio_file), conf)["pred_dict"]
+
+    source_file = audio_file
+    if kind == "flac":
+        source_file = tmp_path / (audio_file.stem + ".flac")
+        samples, sample_rate = sf.read(audio_file, dtype="int16")
+        sf.write(source_file, samples, sample_rate, subtype="PCM_16")
+    audio, sample_rate = decode_audio((kind, str(source_file)))
+    pred_dict = backend.process_audio(audio, sample_rate, audio_file.name, conf)["pred_dict"]
+
+    assert pred_dict["id"] == expected["id"]
+    assert pred_dict["class_name"] == expected["class_name"]
+    assert pred_dict["duration"] == pytest.approx(expected["duration"])
+    assert len(pred_dict["annotation"]) == len(expected["annotation"])
+    for a, b in zip(pred_dict["annotation"], expected["annotation"]):
+        assert a["class"] == b["class"]
+        assert a["start_time"] == pytest.approx(b["start_time"])
+        assert a["high_freq"] == b["high_freq"]
+        assert a["det_prob"] == pytest.approx(b["det_prob"], abs=1e-4)
+
+
+def test_reanalyse_exits_when_every_record_fails(tmp_path):
+    # a file with a .wav name that cannot be decoded, as a corrupt recording would be
+    wav_file = tmp_path / "SMU01770-2_20240529_010000.wav"
+    wav_file.write_bytes(b"RIFF")
+    db_path = tmp_path / "test_db.sqlite3"
+    create_schema(db_path)
+    with sqlite3.connect(db_path) as conn:
+        insert_record(
+            conn,
+            (wav_file.name, "GC01", "SMU01770-2", None, 1.0, "None", "2024-05-28", "no", None,
+             None, "no", None, str(wav_file), None),
+        )
+
+    with pytest.raises(SystemExit) as exited:
+        reanalyse.main(db_path, "select id from records", 0.5, workers=1)
+    assert exited.value.code == 1
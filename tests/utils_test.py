@@ -0,0 +1,55 @@
+import shutil
+from pathlib import Path
+import pytest
+from bat_acoustic_tools.utils import (
+    audio_fingerprint,
+    decoded_fingerprint,
+    find_wav_data_chunk,
+)
+
+DATA_DIR = Path(__file__).parent.parent / "data"
+WAV_FILE = DATA_DIR / "SMU01770-2_20240416_022448.wav"
+
+
+def test_find_wav_data_chunk():
+    with open(WAV_FILE, "rb") as f:
+        offset, length = find_wav_data_chunk(f)
+
+    assert offset + length <= WAV_FILE.stat().st_size
+    with open(WAV_FILE, "rb") as f:
+        f.seek(offset - 8)
+        assert f.read(4) == b"data"
+
+
+def test_audio_fingerprint_ignores_name_and_metadata(tmp_path):
+    renamed = tmp_path / "renamed.wav"
+    shutil.copy(WAV_FILE, renamed)
+
+    with open(WAV_FILE, "rb") as f:
+        offset, _ = find_wav_data_chunk(f)
+
+    # change a byte in the metadata chunks ahead of the sample data
+    data = bytearray(renamed.read_bytes())
+    data[offset - 9] ^= 0xFF
+    renamed.write_bytes(bytes(data))
+
+    assert audio_fingerprint(renamed) == audio_fingerprint(WAV_FILE)
+    assert audio_fingerprint(WAV_FILE) != audio_fingerprint(
+        DATA_DIR / "SMU01770-2_20240416_022453.wav"
+    )
+
+
+def test_audio_fingerprint_non_wav(tmp_path):
+    other = tmp_path / "notes.txt"
+    other.write_bytes(b"not a wav file")
+
+    assert len(audio_fingerprint(other)) == 32
+
+
+def test_decoded_fingerprint_matches_wav(tmp_path):
+    sf = pytest.importorskip("soundfile")
+    flac_file = tmp_path / (WAV_FILE.stem + ".flac")
+    audio, sample_rate = sf.read(WAV_FILE, dtype="int16")
+    sf.write(flac_file, audio, sample_rate, subtype="PCM_16")
+
+    assert decoded_fingerprint(flac_file) == audio_fingerprint(WAV_FILE)
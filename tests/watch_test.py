@@ -0,0 +1,53 @@
+import threading
+import time
+import pytest
+from bat_acoustic_tools.watch import scan_wav_files, watch_directory
+
+
+def test_scan_wav_files(tmp_path):
+    data_dir = tmp_path / "GC01" / "Data"
+    data_dir.mkdir(parents=True)
+    (data_dir / "a.wav").write_bytes(b"a")
+    (data_dir / "b.WAV").write_bytes(b"b")
+    (data_dir / "notes.txt").write_text("not audio")
+
+    found = sorted(p.name for p in scan_wav_files(tmp_path))
+
+    assert found == ["a.wav", "b.WAV"]
+
+
+def test_watch_directory_yields_settled_files_once(tmp_path):
+    data_dir = tmp_path / "GC01" / "Data"
+    data_dir.mkdir(parents=True)
+    wav_path = data_dir / "SMU01770-2_20240416_022448.wav"
+    wav_path.write_bytes(b"RIFF")
+
+    found = list(
+        watch_directory(tmp_path, settle_time=0.2, poll_interval=0.1, idle_timeout=0.5)
+    )
+
+    assert found == [wav_path]
+
+
+
+def test_watch_directory_follows_events(tmp_path):
+    pytest.importorskip("watchdog")
+    staging = tmp_path.parent / f"{tmp_path.name}_staging" / "GC02" / "Data"
+    staging.mkdir(parents=True)
+    moved_wav = staging / "SMU01770-2_20240417_010000.wav"
+    moved_wav.write_bytes(b"RIFF")
+    new_wav = tmp_path / "SMU01770-2_20240416_022448.wav"
+
+    def copy_in():
+        time.sleep(0.3)
+        new_wav.write_bytes(b"RIFF")
+        # a whole location directory moved into the tree only raises one event
+        staging.parent.rename(tmp_path / "GC02")
+
+    threading.Thread(target=copy_in).start()
+    # no periodic rescans, new files can only be found from their events
+    found = list(
+        watch_directory(tmp_path, settle_time=0.2, poll_interval=1000, idle_timeout=1.0)
+    )
+
+    assert sorted(found) == sorted([new_wav, tmp_path / "GC02" / "Data" / moved_wav.name])